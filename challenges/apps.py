@@ -1,17 +1,27 @@
-from threading import Thread
+import os
+import sys
 from django.apps import AppConfig
 
 
 
+def serves_requests() -> bool:
+    '''
+    False for management commands and for the autoreloader parent of runserver, they need no reference data.
+    runserver serves from the reloaded child (RUN_MAIN set), or from the process itself with --noreload.'''
+    if os.path.basename(sys.argv[0]) not in ('manage.py', 'django-admin'):
+        return True
+    if sys.argv[1:2] != ['runserver']:
+        return False
+    return '--noreload' in sys.argv[2:] or os.environ.get('RUN_MAIN') == 'true'
+
+
 class ChallengesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'challenges'
 
     def ready(self):
-        from .task import listen_to_changes,load_bhpont_table, load_bhszakasz_table,load_graph_cache
-
-        load_bhpont_table()
-        load_bhszakasz_table()
-        load_graph_cache()
+        if not serves_requests():
+            return
+        from .task import warm_up
 
-        Thread(target=listen_to_changes, daemon=True).start()
\ No newline at end of file
+        warm_up()
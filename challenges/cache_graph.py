@@ -1,17 +1,24 @@
 from datetime import datetime
+from functools import lru_cache
 import re
-from typing import List
-import networkx as nx
+from typing import Dict, List
 
+from challenges.compiled_graph import CompiledTrailGraph
+from challenges.cost_model import DB_COST
 from challenges.enums import StampType
 from challenges.models import BHD, BHSzD, BHSzakasz
+from challenges.records import BHRecord
+from challenges.trail_chain import TrailChain
 
+BH_ID_NUMBER = re.compile(r"(AKPH|DDKPH|OKTPH)_(\d+)")
+
+@lru_cache(maxsize=None)
 def extract_parts(bh_id: str, mozgalom: str) -> int:
-    """Extract relevant parts based on mozgalom."""
+    """Extract relevant parts based on mozgalom, computed once per point and trail."""
     if mozgalom == "RPDDK":
         mozgalom = "DDK"
     # Match all relevant prefixes and their associated numbers
-    matches = re.findall(r"(AKPH|DDKPH|OKTPH)_(\d+)", bh_id)
+    matches = BH_ID_NUMBER.findall(bh_id)
     if matches:
         # Convert to a dictionary for easy lookup
         prefix_dict = {prefix: int(number) for prefix, number in matches}
@@ -25,10 +32,7 @@ def sort_bhszd_key(bhszd, mozgalom: str):
     vegpont_key = extract_parts(bhszd.bh_szakasz.vegpont_bh_id, mozgalom)
     return (kezdopont_key, vegpont_key)
 
-def build_cache_graph(bhszd_sections: List[BHSzD], mozgalom:str):
-        graph = nx.MultiDiGraph()
-        
-        
+def build_cache_graph(bhszd_sections: List[BHSzD], mozgalom:str, bh_cache:Dict[str, BHRecord]=None) -> CompiledTrailGraph:
         sorted_bhszd_sections: List[BHSzD] = sorted(
             bhszd_sections, key=lambda bhszd: sort_bhszd_key(bhszd, mozgalom)
         )
@@ -45,11 +49,14 @@ def build_cache_graph(bhszd_sections: List[BHSzD], mozgalom:str):
                     mozgalom=mozgalom,
                     stamp_type=StampType.DB,
                     validation_time=datetime.now(),
-                    kezdopont=BHD.create_bhd_from_bh_id(end),
-                    vegpont=BHD.create_bhd_from_bh_id(new_id),
+                    kezdopont=BHD.create_bhd_from_bh_id(end, bh_cache),
+                    vegpont=BHD.create_bhd_from_bh_id(new_id, bh_cache),
                     )
                 edges_for_graph.append(visegrad_nagymaros_komp)
 
-        for bhszd in edges_for_graph:
-            graph.add_edge(bhszd.bh_szakasz.kezdopont_bh_id,bhszd.bh_szakasz.vegpont_bh_id,BHSzD=bhszd, weight=999999999999999999999999999)
+        graph = CompiledTrailGraph.from_edges(
+            (bhszd.bh_szakasz.kezdopont_bh_id, bhszd.bh_szakasz.vegpont_bh_id, DB_COST, bhszd)
+            for bhszd in edges_for_graph
+        )
+        graph.chain = TrailChain.from_graph(graph, BHSzakasz._meta.get_field('tav').decimal_places)
         return graph
\ No newline at end of file
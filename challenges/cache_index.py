@@ -0,0 +1,187 @@
+from bisect import bisect_right
+from datetime import datetime
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+from challenges.column_table import NULL, ColumnTable, to_epoch
+from challenges.records import BHRecord, BHSzakaszRecord, NagySzakaszRecord
+
+
+class TemporalIndex:
+    '''
+    Groups the row positions of a versioned ColumnTable by key, each key holding its versions sorted by start_date.
+    Records are only materialized for the version a lookup returns.
+    Subclasses name the KEY_COLUMNS their key is made of by make_key.
+    '''
+    KEY_COLUMNS: Tuple[str, ...] = ()
+
+    def __init__(self, table: ColumnTable = None) -> None:
+        self.table = table if table is not None else ColumnTable()
+        self._starts: Dict[Hashable, List[int]] = {}
+        self._versions: Dict[Hashable, List[int]] = {}
+
+    def _start_of(self, position: int) -> int:
+        # A missing start_date is NULL, which sorts before every version
+        return int(self.table.column('start_date')[position])
+
+    @staticmethod
+    def make_key(*values) -> Hashable:
+        return values[0]
+
+    @classmethod
+    def key_of(cls, table: ColumnTable, position: int) -> Hashable:
+        return cls.make_key(*(table.column(name)[position] for name in cls.KEY_COLUMNS))
+
+    @classmethod
+    def from_table(cls, table: ColumnTable) -> "TemporalIndex":
+        positions = table.live_positions()
+        index = cls()
+        index.add({name: table.column(name)[positions] for name in (*cls.KEY_COLUMNS, 'start_date')}, positions.tolist())
+        return index.finish(table)
+
+    def add(self, columns: Dict[str, np.ndarray], positions: Iterable[int]) -> None:
+        '''
+        Put the rows at `positions` in from their key and start_date columns (e.g. one chunk of a table being
+        loaded), unsorted until finish()
+        '''
+        keys = map(self.make_key, *(columns[name].tolist() for name in self.KEY_COLUMNS))
+        for key, start, position in zip(keys, columns['start_date'].tolist(), positions):
+            self._versions.setdefault(key, []).append(position)
+            self._starts.setdefault(key, []).append(start)
+
+    def finish(self, table: ColumnTable) -> "TemporalIndex":
+        '''Attach the table the added rows belong to and sort every key's versions by start_date once'''
+        self.table = table
+        for key, versions in self._versions.items():
+            starts = self._starts[key]
+            order = sorted(range(len(versions)), key=starts.__getitem__)
+            self._versions[key] = [versions[i] for i in order]
+            self._starts[key] = [starts[i] for i in order]
+        return self
+
+    def patched(self, table: ColumnTable, removed: Iterable[int] = (), added: Iterable[int] = ()) -> "TemporalIndex":
+        '''
+        Copy of the index over `table`, a patched copy of this index's table, with the `removed` positions
+        taken out and the `added` ones put in. Untouched keys share their version lists with this index,
+        which stays valid for its readers.
+        '''
+        index = type(self)(table)
+        index._versions = dict(self._versions)
+        index._starts = dict(self._starts)
+        touched: Dict[Hashable, List[int]] = {}
+        for position in removed:
+            key = self.key_of(table, position)
+            versions = touched.setdefault(key, list(self._versions.get(key, [])))
+            versions[:] = [version for version in versions if version != position]
+        for position in added:
+            key = self.key_of(table, position)
+            touched.setdefault(key, list(self._versions.get(key, []))).append(position)
+        for key, versions in touched.items():
+            if versions:
+                versions.sort(key=index._start_of)
+                index._versions[key] = versions
+                index._starts[key] = [index._start_of(position) for position in versions]
+            else:
+                index._versions.pop(key, None)
+                index._starts.pop(key, None)
+        return index
+
+    def versions(self, key: Hashable) -> List[int]:
+        return self._versions.get(key, [])
+
+    def records(self, key: Hashable) -> List[Any]:
+        '''The records of every version of `key`, earliest started first'''
+        return [self.table.record(position) for position in self.versions(key)]
+
+    def valid_versions(self, key: Hashable, timestamp: datetime) -> Iterator[int]:
+        '''Yield the positions of the versions of `key` valid at `timestamp`, latest started first'''
+        starts = self._starts.get(key)
+        if not starts:
+            return
+        versions = self._versions[key]
+        moment = to_epoch(timestamp)
+        end_dates = self.table.column('end_date')
+        for position in range(bisect_right(starts, moment) - 1, -1, -1):
+            if starts[position] == NULL:
+                # Like start_date <= moment in SQL, a version without start_date is never valid
+                break
+            row = versions[position]
+            if end_dates[row] == NULL or end_dates[row] >= moment:
+                yield row
+
+    def lookup(self, key: Hashable, timestamp: datetime) -> Optional[Any]:
+        '''Return the record of the version of `key` valid at `timestamp`, preferring the latest started one'''
+        position = next(self.valid_versions(key, timestamp), None)
+        return self.table.record(position) if position is not None else None
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+
+class BHPontIndex(TemporalIndex):
+    '''Stamp point versions keyed by mtsz_id'''
+    KEY_COLUMNS = ('mtsz_id',)
+
+    def resolve_many(self, lookups: Iterable[Tuple[str, datetime]]) -> List[Optional[BHRecord]]:
+        '''Resolve every (mtsz_id, timestamp) pair of a request, memoizing repeated pairs'''
+        resolved: Dict[Tuple[str, datetime], Optional[BHRecord]] = {}
+        result = []
+        for lookup in lookups:
+            if lookup not in resolved:
+                resolved[lookup] = self.lookup(*lookup)
+            result.append(resolved[lookup])
+        return result
+
+
+class BHSzakaszIndex(TemporalIndex):
+    '''Section versions keyed by the unordered (kezdopont_bh_id, vegpont_bh_id) pair and okk_mozgalom'''
+    KEY_COLUMNS = ('kezdopont_bh_id', 'vegpont_bh_id', 'okk_mozgalom')
+
+    @staticmethod
+    def make_key(bh_id_a: str, bh_id_b: str, mozgalom: str) -> Tuple[str, str, str]:
+        return (*sorted((bh_id_a or '', bh_id_b or '')), mozgalom)
+
+    def lookup_section(self, start_bh_id: str, end_bh_id: str, mozgalom: str,
+                       section_date: datetime) -> Optional[BHSzakaszRecord]:
+        '''Return the section between two points valid at `section_date` in either direction, preferring the forward one'''
+        reverse_match = None
+        starts, ends = self.table.column('kezdopont_bh_id'), self.table.column('vegpont_bh_id')
+        for position in self.valid_versions(self.make_key(start_bh_id, end_bh_id, mozgalom), section_date):
+            if starts[position] == start_bh_id and ends[position] == end_bh_id:
+                return self.table.record(position)
+            if reverse_match is None:
+                reverse_match = position
+        return self.table.record(reverse_match) if reverse_match is not None else None
+
+
+class TuramozgalomIndex(TemporalIndex):
+    '''Trail versions keyed by okk_mozgalom'''
+    KEY_COLUMNS = ('okk_mozgalom',)
+
+
+class NagySzakaszIndex(TemporalIndex):
+    '''Main section versions keyed by nagyszakasz_id'''
+    KEY_COLUMNS = ('nagyszakasz_id',)
+
+    def covering(self, nagyszakasz_id: str, min_date: datetime, max_date: datetime) -> Optional[NagySzakaszRecord]:
+        '''
+        The version of a main section valid over the whole [min_date, max_date] interval. Like ORDER BY end_date
+        the earliest ending version wins and an open ended one comes last, versions without start_date never match.
+        '''
+        starts = self._starts.get(nagyszakasz_id)
+        if not starts:
+            return None
+        started = bisect_right(starts, to_epoch(min_date))
+        end_moment = to_epoch(max_date)
+        end_dates = self.table.column('end_date')
+        best, best_end = None, None
+        for start, position in zip(starts[:started], self._versions[nagyszakasz_id][:started]):
+            if start == NULL:
+                continue
+            end = int(end_dates[position])
+            if end != NULL and end < end_moment:
+                continue
+            end = end if end != NULL else np.iinfo(np.int64).max
+            if best is None or end < best_end:
+                best, best_end = position, end
+        return self.table.record(best) if best is not None else None
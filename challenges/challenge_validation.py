@@ -6,27 +6,34 @@ from challenges.enums import BookletTypes, DirectionType, StampType
 from challenges.models import BHD, BH, BHDList, BHSzD, BHSzakasz
 
 from challenges.statistic import KekturaStatistics
-from challenges.task import get_bhpont_cache, get_bhszakasz_cache
+from challenges.snapshot import ReferenceSnapshot
+from challenges.task import wait_for_reference_snapshot
 
 
 class ChallengeValidation:
     '''Class to proccess BHD and BHSZD '''
     def __init__(self, request, testing) -> None:
         self.testing = testing
+        self.snapshot: ReferenceSnapshot = wait_for_reference_snapshot()
         self.validated_bhszd:List[BHSzD] = []
         self.mozgalom: BookletTypes = request.data.get('bookletWhichBlue',None)
         self.birth_year: int = int(request.data.get('birth_year',None))
         self.gykt_already: bool = True if request.data.get('gykt_done',None) == "true" else False
         self.BHD_list:BHDList[BHD] = self.create_BHD_objects(request)
-        self.kezdopont, self.vegpont = BH.get_mozgalom_start_end_BH(self.BHD_list, self.mozgalom)
+        self.kezdopont, self.vegpont = BH.get_mozgalom_start_end_BH(self.mozgalom, self.snapshot.turamozgalom_index)
         self.sort_BHDs()
         self.validate_bhszd_sections()
-        self.nodeGraph = NodeGraph(self.kezdopont,self.vegpont,self.validated_bhszd,self.mozgalom, testing=self.testing)
+        cached_graph = self.snapshot.graph(self.mozgalom)
+        self.nodeGraph = NodeGraph(self.kezdopont,self.vegpont,self.validated_bhszd,self.mozgalom, testing=self.testing,
+                                   cached_graph=cached_graph,
+                                   nagyszakasz_index=self.snapshot.nagyszakasz_index)
         self.nodeGraph.validate_mozgalom()
         self.statistics = KekturaStatistics(
             validated_bhd=self.BHD_list,
             validated_bhszd=self.validated_bhszd,
             best_path=self.nodeGraph.best_path, 
+            stamped_path=self.nodeGraph.stamped_path,
+            trail_chain=cached_graph.chain if cached_graph is not None else None,
             completed_nagyszakasz=self.nodeGraph.completed_nagyszakasz, 
             all_nagyszakasz = self.nodeGraph.all_nagyszakasz,
             birth_year=self.birth_year,
@@ -36,12 +43,13 @@ class ChallengeValidation:
 
     def create_BHD_objects(self, request)->BHDList[BHD]:
         '''Converts the request to a list of BHD objects'''
-        bh_cache = get_bhpont_cache()  
+        bh_index = self.snapshot.bhpont_index
         bhd_list: BHDList[BHD] = BHDList()
 
-        for stamp in request.data.get('stamps', []):
-            timestamp = self.process_timestamps(stamp)
-            bh: BH = BH.create_BH_from_request(stamp, bh_cache, timestamp)
+        stamps = request.data.get('stamps', [])
+        timestamps = [self.process_timestamps(stamp) for stamp in stamps]
+        bhs = BH.create_BHs_from_request(stamps, bh_index, timestamps)
+        for stamp, timestamp, bh in zip(stamps, timestamps, bhs):
             if bh:
                 bhd: BHD = BHD.create_bhd_from_bh(bh, timestamp, stamp.get('fulfillmentType'))
                 bhd_list.append(bhd)
@@ -65,25 +73,22 @@ class ChallengeValidation:
         self.BHD_list.sort(key=sort_key)
 
     def validate_bhszd_sections(self):
+        pairs: List[Tuple[BHD, BHD, datetime]] = []
         for i,a in enumerate(self.BHD_list[:-1]):
             if a.stamping_date.date() + timedelta(days=1) < self.BHD_list[i+1].stamping_date.date():
                 continue
-            else:
-                section_date:datetime = min(a.stamping_date, self.BHD_list[i+1].stamping_date)
-                bh_szakasz = self.find_section(a, self.BHD_list[i+1],section_date)
-                if bh_szakasz:
-                    bhszd_stamp_type:StampType = self._get_stamp_type([a,self.BHD_list[i+1]])
-                    if bhszd_stamp_type.value == "digistamp":
-                        is_valid,speed = self.velocity_checked(bh_szakasz.tav, a.stamping_date, self.BHD_list[i+1].stamping_date)
-                        if is_valid:
-                            self._add_to_validated_bhszd(bh_szakasz, bhszd_stamp_type,a,self.BHD_list[i+1],speed)
-                            continue
-                        else:
-                            continue
-                    else:
-                        self._add_to_validated_bhszd(bh_szakasz, bhszd_stamp_type,a,self.BHD_list[i+1])
-                        continue
-                
+            section_date:datetime = min(a.stamping_date, self.BHD_list[i+1].stamping_date)
+            pairs.append((a, self.BHD_list[i+1], section_date))
+
+        for (a, b, section_date), bh_szakasz in zip(pairs, self.find_sections(pairs)):
+            if bh_szakasz:
+                bhszd_stamp_type:StampType = self._get_stamp_type([a,b])
+                if bhszd_stamp_type.value == "digistamp":
+                    is_valid,speed = self.velocity_checked(bh_szakasz.tav, a.stamping_date, b.stamping_date)
+                    if is_valid:
+                        self._add_to_validated_bhszd(bh_szakasz, bhszd_stamp_type,a,b,speed)
+                else:
+                    self._add_to_validated_bhszd(bh_szakasz, bhszd_stamp_type,a,b)
 
     def _add_to_validated_bhszd(self, bh_szakasz: BHSzakasz, bhszd_stamp_type:StampType, a_BHD:BHD, b_BHD:BHD, speed:float=None)->None:
         start, end = self._match_bhd_with_section_ends(a_BHD, b_BHD, bh_szakasz)
@@ -102,27 +107,23 @@ class ChallengeValidation:
         return StampType.Kezi if any(stamp.stamp_type == StampType.Kezi.value for stamp in BHDS) else StampType.Digital
 
 
-    def find_section(self, start_BHD:BHD, end_BHD:BHD,section_date:datetime)->BHSzakasz:
-        """Attempt to find a BHSzakasz from DB between two BHD stamps"""
-        bhszakasz_cache = get_bhszakasz_cache()
-        section_match = next(
-        (
-            section for section in bhszakasz_cache
-            if section['kezdopont_bh_id'] == start_BHD.bh.bh_id
-            and section['vegpont_bh_id'] == end_BHD.bh.bh_id
-            and section['start_date'] <= section_date
-            and (section['end_date'] is None or section['end_date'] >= section_date)
-        ),
-        None
-    )
-        if section_match:
-            return BHSzakasz(**section_match)
-        else:
-            try:
-                bh_szakasz = BHSzakasz.get_from_DB(start_BHD,end_BHD,section_date, self.mozgalom)
-                return bh_szakasz
-            except BHSzakasz.DoesNotExist:
-                return None 
+    def find_sections(self, pairs:List[Tuple[BHD, BHD, datetime]])->List[BHSzakasz]:
+        """
+        Find the BHSzakasz between the two BHD stamps of every pair, from the BHSZAKASZ index,
+        resolving all the misses of the index with a single DB query
+        """
+        sections = [
+            self.snapshot.bhszakasz_index.lookup_section(start_BHD.bh.bh_id, end_BHD.bh.bh_id, self.mozgalom, section_date)
+            for start_BHD, end_BHD, section_date in pairs
+        ]
+        misses = [i for i, section_match in enumerate(sections) if not section_match]
+        if misses:
+            db_sections = BHSzakasz.get_many_from_DB(
+                [(pairs[i][0].bh.bh_id, pairs[i][1].bh.bh_id, pairs[i][2]) for i in misses], self.mozgalom
+            )
+            for i, bh_szakasz in zip(misses, db_sections):
+                sections[i] = bh_szakasz
+        return sections
 
     def _get_direction(self,start:BHD, end:BHD, stamp_type:StampType) -> DirectionType:
         """Helper to determine if the direction of travel is forward or reverse."""
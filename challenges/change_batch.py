@@ -0,0 +1,46 @@
+import time
+from typing import Dict, Optional, Set
+
+
+class ChangeBatch:
+    '''
+    Notifications collected by the change listener during one window.
+    Changes are merged per channel and objectid (the last operation wins, the row is re-read anyway),
+    a channel that needs a full reload drops its row changes. The window closes after `window_seconds`
+    from its first notification or once `max_size` notifications arrived.
+    '''
+    def __init__(self, window_seconds: float, max_size: int) -> None:
+        self.window_seconds = window_seconds
+        self.max_size = max_size
+        self.received = 0
+        self.opened_at: Optional[float] = None
+        self.changes: Dict[str, Dict[int, dict]] = {}
+        self.full_reload: Set[str] = set()
+
+    def add(self, channel: str, change: Optional[dict]) -> None:
+        '''Add a parsed notification, None means the channel needs a full reload'''
+        if self.opened_at is None:
+            self.opened_at = time.monotonic()
+        self.received += 1
+        if change is None:
+            self.full_reload.add(channel)
+            self.changes.pop(channel, None)
+        elif channel not in self.full_reload:
+            self.changes.setdefault(channel, {})[change['objectid']] = change
+
+    @property
+    def empty(self) -> bool:
+        return self.received == 0
+
+    @property
+    def merged(self) -> int:
+        return len(self.full_reload) + sum(len(changes) for changes in self.changes.values())
+
+    def remaining(self) -> Optional[float]:
+        '''Seconds until the window closes, None while no notification arrived'''
+        if self.opened_at is None:
+            return None
+        return max(0.0, self.opened_at + self.window_seconds - time.monotonic())
+
+    def is_due(self) -> bool:
+        return not self.empty and (self.received >= self.max_size or self.remaining() == 0)
@@ -0,0 +1,216 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+import sys
+from collections.abc import Mapping
+from itertools import islice
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+from django.db import models
+
+# Missing value of the int64 columns, sorts before every real value
+NULL = np.iinfo(np.int64).min
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_epoch(value: Optional[datetime]) -> int:
+    '''Naive datetime as microseconds since the epoch, NULL for None'''
+    return NULL if value is None else (value - EPOCH) // MICROSECOND
+
+
+def from_epoch(value: int) -> Optional[datetime]:
+    return None if value == NULL else EPOCH + timedelta(microseconds=int(value))
+
+
+class ColumnTable:
+    '''
+    Reference table stored column-wise. Strings are interned object arrays, so an id repeated across rows
+    and tables is one object; integers, decimals (scaled to their decimal places) and datetimes (epoch
+    microseconds) are int64 arrays with NULL for missing values. Rows are addressed by position and only
+    materialized as `record_type` records when a lookup hands one out, then kept and shared by later lookups.
+    Tables are immutable: patched() tombstones and appends, so positions held by an index stay valid, and
+    compacted() drops the tombstoned rows once they make up COMPACT_RATIO of the table.
+    '''
+    COMPACT_RATIO = 0.25
+
+    def __init__(self, schema: Dict[str, Tuple[str, int]] = None, record_type: type = None,
+                 columns: Dict[str, np.ndarray] = None, live: np.ndarray = None,
+                 positions: Dict[int, int] = None, records: Dict[int, Any] = None) -> None:
+        self.schema = schema or {}
+        self.record_type = record_type
+        self.columns = columns or {}
+        self.live = live if live is not None else np.zeros(0, dtype=bool)
+        self.positions = positions or {}
+        # A position always holds the same row, so patched copies take over the materialized live records
+        self._records = records if records is not None else {}
+
+    def __getstate__(self) -> dict:
+        state = dict(self.__dict__)
+        state['_records'] = {}
+        return state
+
+    @staticmethod
+    def schema_of(model, columns: List[str]) -> Dict[str, Tuple[str, int]]:
+        '''Storage kind (and decimal places) of each loaded column, from the model fields'''
+        schema = {}
+        for name in columns:
+            field = model._meta.get_field(name)
+            if isinstance(field, models.DecimalField):
+                schema[name] = ('decimal', field.decimal_places)
+            elif isinstance(field, models.DateTimeField):
+                schema[name] = ('datetime', 0)
+            elif isinstance(field, (models.CharField, models.TextField)):
+                schema[name] = ('str', 0)
+            else:
+                schema[name] = ('int', 0)
+        return schema
+
+    @staticmethod
+    def _encode(kind: str, places: int, value: Any) -> Any:
+        if kind == 'str':
+            return sys.intern(value) if value is not None else None
+        if value is None:
+            return NULL
+        if kind == 'decimal':
+            return int(value.scaleb(places))
+        if kind == 'datetime':
+            return to_epoch(value)
+        return int(value)
+
+    @staticmethod
+    def _decode(kind: str, places: int, value: Any) -> Any:
+        if kind == 'str':
+            return value
+        if value == NULL:
+            return None
+        if kind == 'decimal':
+            return Decimal(int(value)).scaleb(-places)
+        if kind == 'datetime':
+            return from_epoch(value)
+        return int(value)
+
+    def _encode_chunk(self, rows: List[Tuple]) -> Dict[str, np.ndarray]:
+        '''Encode rows of values in schema order into one array per column, filled straight from the values'''
+        return {
+            name: np.fromiter(
+                (self._encode(kind, places, row[column]) for row in rows),
+                dtype=object if kind == 'str' else np.int64, count=len(rows),
+            )
+            for column, (name, (kind, places)) in enumerate(self.schema.items())
+        }
+
+    def _encode_columns(self, rows: Iterable[Tuple], chunk_size: int = None,
+                        on_chunk: Callable[[Dict[str, np.ndarray], int], None] = None) -> Dict[str, np.ndarray]:
+        '''
+        Encode rows of values in schema order into one array per column, `chunk_size` rows at a time, so no list
+        of the whole table is built. `on_chunk` gets the arrays of every chunk and the position of its first row.
+        '''
+        rows = iter(rows)
+        chunks: List[Dict[str, np.ndarray]] = []
+        offset = 0
+        while True:
+            rows_of_chunk = list(islice(rows, chunk_size))
+            if not rows_of_chunk:
+                break
+            chunk = self._encode_chunk(rows_of_chunk)
+            if on_chunk is not None:
+                on_chunk(chunk, offset)
+            chunks.append(chunk)
+            offset += len(rows_of_chunk)
+        if len(chunks) <= 1:
+            return chunks[0] if chunks else self._encode_chunk([])
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in self.schema}
+
+    @classmethod
+    def from_rows(cls, schema: Dict[str, Tuple[str, int]], record_type: type, rows: Iterable[Tuple],
+                  chunk_size: int = None, on_chunk: Callable[[Dict[str, np.ndarray], int], None] = None) -> "ColumnTable":
+        '''
+        Build the table from rows of values in schema order, an objectid column is required.
+        See _encode_columns for `chunk_size` and `on_chunk`, e.g. to fill an index during the same pass.
+        '''
+        table = cls(schema, record_type)
+        table.columns = table._encode_columns(rows, chunk_size, on_chunk)
+        table.live = np.ones(len(table.columns['objectid']), dtype=bool)
+        table.positions = {objectid: position for position, objectid in enumerate(table.columns['objectid'].tolist())}
+        return table
+
+    def patched(self, removed: Iterable[int] = (), added: Iterable[Any] = ()) -> "ColumnTable":
+        '''Copy with the `removed` objectids tombstoned and the `added` rows appended, this table stays valid'''
+        live = self.live.copy()
+        positions = dict(self.positions)
+        for objectid in removed:
+            position = positions.pop(objectid, None)
+            if position is not None:
+                live[position] = False
+        records = {position: record for position, record in self._records.items() if live[position]}
+        added = list(added)
+        if not added:
+            return type(self)(self.schema, self.record_type, self.columns, live, positions, records)
+
+        appended = self._encode_chunk([tuple(getattr(record, name) for name in self.schema) for record in added])
+        columns = {name: np.concatenate([self.columns[name], appended[name]]) for name in self.schema}
+        for position, record in enumerate(added, start=len(live)):
+            positions[record.objectid] = position
+        live = np.concatenate([live, np.ones(len(added), dtype=bool)])
+        return type(self)(self.schema, self.record_type, columns, live, positions, records)
+
+    def needs_compaction(self) -> bool:
+        return len(self.live) - len(self.positions) > self.COMPACT_RATIO * len(self.live)
+
+    def compacted(self) -> "ColumnTable":
+        '''Copy without the tombstoned rows, the live rows are renumbered so indexes must be rebuilt over it'''
+        kept = self.live_positions()
+        columns = {name: column[kept] for name, column in self.columns.items()}
+        positions = {int(objectid): position for position, objectid in enumerate(columns['objectid'])}
+        records = {
+            position: self._records[old_position]
+            for position, old_position in enumerate(kept.tolist()) if old_position in self._records
+        }
+        return type(self)(self.schema, self.record_type, columns, np.ones(len(kept), dtype=bool), positions, records)
+
+    def column(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def live_positions(self, mask: np.ndarray = None) -> np.ndarray:
+        '''Positions of the live rows, optionally only those selected by a boolean mask over the columns'''
+        return np.flatnonzero(self.live if mask is None else self.live & mask)
+
+    def position_of(self, objectid: int) -> Optional[int]:
+        return self.positions.get(objectid)
+
+    def record(self, position: int) -> Any:
+        record = self._records.get(position)
+        if record is None:
+            record = self._records.setdefault(position, self.record_type(**{
+                name: self._decode(kind, places, self.columns[name][position])
+                for name, (kind, places) in self.schema.items()
+            }))
+        return record
+
+    def get(self, objectid: int) -> Optional[Any]:
+        position = self.positions.get(objectid)
+        return self.record(position) if position is not None else None
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+
+class RecordMap(Mapping):
+    '''
+    Read-only key -> record view over selected rows of a ColumnTable, the first row of a key wins.
+    Only the positions are kept, a record is materialized when it is looked up.
+    '''
+    def __init__(self, table: ColumnTable, key_column: str, positions: np.ndarray) -> None:
+        self.table = table
+        self._positions: Dict[Hashable, int] = {}
+        for key, position in zip(table.column(key_column)[positions].tolist(), positions.tolist()):
+            self._positions.setdefault(key, position)
+
+    def __getitem__(self, key: Hashable) -> Any:
+        return self.table.record(self._positions[key])
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        return len(self._positions)
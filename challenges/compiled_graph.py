@@ -0,0 +1,105 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+from challenges.shortest_path import ShortestPathEngine, cheapest_parallel_edges, topological_order
+
+
+class CompiledTrailGraph:
+    '''
+    Immutable trail graph with interned integer node ids and CSR adjacency in NumPy arrays.
+    The outgoing edges of node u are the positions indptr[u]:indptr[u+1] of the parallel edge arrays.
+    Edge weights are the int64 costs of the TieredCostModel.
+    Trail graphs are chains, so the topological order is computed once here and lets path searches
+    run a linear-time DAG relaxation, it is None when the graph has a cycle.
+    `chain` holds the TrailChain prefix sums the trail graph builder attaches, None when the trail branches.
+    '''
+    def __init__(self, node_ids: List[str], indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray,
+                 sections: np.ndarray, bhszds: List[Any]) -> None:
+        self.node_ids: List[str] = node_ids
+        self.node_index: Dict[str, int] = {node: i for i, node in enumerate(node_ids)}
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.sections = sections
+        self.bhszds = bhszds
+        self.chain = None
+        order = topological_order(self.num_nodes, self._targets)
+        self.topological_order: Optional[np.ndarray] = None
+        self.topological_position: Optional[np.ndarray] = None
+        if order is not None:
+            self.topological_order = np.asarray(order, dtype=np.int32)
+            self.topological_position = np.empty(self.num_nodes, dtype=np.int32)
+            self.topological_position[self.topological_order] = np.arange(self.num_nodes, dtype=np.int32)
+
+    @classmethod
+    def from_edges(cls, edges: Iterable[Tuple[str, str, int, Any]]) -> "CompiledTrailGraph":
+        '''Compile (start, end, weight, BHSzD) edges, keeping the insertion order of nodes and of parallel edges'''
+        node_index: Dict[str, int] = {}
+        sources, targets, weights, bhszds = [], [], [], []
+        for start, end, weight, bhszd in edges:
+            sources.append(node_index.setdefault(start, len(node_index)))
+            targets.append(node_index.setdefault(end, len(node_index)))
+            weights.append(weight)
+            bhszds.append(bhszd)
+
+        sources = np.asarray(sources, dtype=np.int32)
+        order = np.argsort(sources, kind='stable')
+        indptr = np.zeros(len(node_index) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(node_index)), out=indptr[1:])
+        return cls(
+            node_ids=list(node_index),
+            indptr=indptr,
+            indices=np.asarray(targets, dtype=np.int32)[order],
+            weights=np.asarray(weights, dtype=np.int64)[order],
+            sections=order.astype(np.int32),
+            bhszds=bhszds,
+        )
+
+    @classmethod
+    def empty(cls) -> "CompiledTrailGraph":
+        return cls.from_edges([])
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.indices)
+
+    def node_id(self, node: str) -> Optional[int]:
+        return self.node_index.get(node)
+
+    def _targets(self, u: int) -> List[Tuple[int]]:
+        return [(v,) for v in self.indices[self.indptr[u]:self.indptr[u + 1]].tolist()]
+
+    def out_edges(self, u: int) -> List[Tuple[int, int, int, Any]]:
+        '''(position, v, weight, BHSzD) for every outgoing edge of u, in insertion order'''
+        if u >= self.num_nodes:
+            return []
+        start, end = int(self.indptr[u]), int(self.indptr[u + 1])
+        return [
+            (position, v, weight, self.bhszds[section])
+            for position, v, weight, section in zip(
+                range(start, end),
+                self.indices[start:end].tolist(),
+                self.weights[start:end].tolist(),
+                self.sections[start:end].tolist(),
+            )
+        ]
+
+    def neighbours(self, u: int) -> Iterable[Tuple[int, int, Any]]:
+        return cheapest_parallel_edges((v, weight, bhszd) for _, v, weight, bhszd in self.out_edges(u))
+
+    def shortest_path(self, source: str, target: str) -> Optional[List[Any]]:
+        '''BHSzD edges of the cheapest path between two bh_ids, None if there is none'''
+        source_id, target_id = self.node_id(source), self.node_id(target)
+        if source_id is None or target_id is None:
+            return None
+        engine = ShortestPathEngine(self.neighbours)
+        if self.topological_order is not None:
+            return engine.dag_shortest_path(self.topological_order.tolist(), source_id, target_id)
+        return engine.shortest_path(source_id, target_id)
+
+    def __repr__(self) -> str:
+        return f"CompiledTrailGraph with {self.num_nodes} nodes and {self.num_edges} edges"
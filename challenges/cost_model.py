@@ -0,0 +1,33 @@
+from datetime import datetime
+from challenges.enums import StampType
+
+# DB sections cost 2**DB_SHIFT, more than the stamp costs of any path add up to, so path costs compare
+# lexicographically on (DB sections, stamp costs) and stay int64 for up to 2**19 DB sections
+DB_SHIFT = 44
+DB_COST = 1 << DB_SHIFT
+
+
+def is_db_cost(cost: int) -> bool:
+    return cost >= DB_COST
+
+
+class TieredCostModel:
+    '''
+    Edge costs of the trail graphs as fixed-width integers.
+    A stamped section costs the base of its tier (digital stamps are preferred over register ones) plus the minutes
+    since it was stamped, a DB section costs DB_COST. This orders and ties paths exactly like the former
+    999999999999999999999999999 DB weight did, without arbitrary-precision arithmetic in the path search.
+    '''
+    TIERS = {
+        StampType.Digital: 1,
+        StampType.Kezi: 100000000,
+    }
+
+    def __init__(self, now: datetime = None) -> None:
+        self.now = now if now is not None else datetime.now()
+
+    def cost(self, bhszd) -> int:
+        if bhszd.stamp_type == StampType.DB:
+            return DB_COST
+        minutes = abs((self.now - bhszd.stamping_date).total_seconds())/60
+        return int(self.TIERS.get(bhszd.stamp_type, self.TIERS[StampType.Digital]) + minutes)
@@ -19,6 +19,13 @@ class DirectionType(Enum):
     Reverse = "reverse"
     Unknown = "unknown"
 
+
+class WarmupState(Enum):
+    Cold = "cold"
+    Loading = "loading"
+    Ready = "ready"
+    Stale = "stale"
+
 @dataclass
 class JSONBH(ABC):
     mtsz_id: str
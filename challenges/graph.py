@@ -4,27 +4,36 @@ import io
 import re
 from typing import List
 import matplotlib
-import heapq
 from challenges.enums import DirectionType, StampType
 
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import networkx as nx
+from challenges.cache_index import NagySzakaszIndex
+from challenges.compiled_graph import CompiledTrailGraph
+from challenges.cost_model import TieredCostModel
 from challenges.models import BHD, BHSzD, BHSzakasz, CustomNagyszakasz
+from challenges.overlay_graph import OverlayGraph
 
 class NodeGraph:
-    def __init__(self, kezdopont: str, vegpont: str, bhszd_sections: List[BHSzD],mozgalom:str,testing):
+    def __init__(self, kezdopont: str, vegpont: str, bhszd_sections: List[BHSzD],mozgalom:str,testing, cached_graph: CompiledTrailGraph = None,
+                 nagyszakasz_index: NagySzakaszIndex = None, cost_model: TieredCostModel = None):
         self.testing = testing
+        self.cached_graph = cached_graph
+        self.nagyszakasz_index = nagyszakasz_index if nagyszakasz_index is not None else NagySzakaszIndex()
         self.kezdopont = kezdopont
         self.vegpont = vegpont
         self.mozgalom = mozgalom
         self.bhszd_sections = bhszd_sections
         self.current_time = datetime.now()
+        self.cost_model = cost_model if cost_model is not None else TieredCostModel(self.current_time)
         self.bhszd_graph = None
         self.bhszd_graph_image = None
         self.validated_graph = None
         self.validated_graph_image = None
         self.best_path = None
+        # The validated sections of the best path, in path order
+        self.stamped_path: List[BHSzD] = []
         self._create_graph()
         self.completed_nagyszakasz = 0
         self.all_nagyszakasz = 0
@@ -33,7 +42,7 @@ class NodeGraph:
     def _create_graph(self):
         self.bhszd_graph = self._build_graph(self.bhszd_sections)
         if self.testing:
-            self.bhszd_graph_image=self._create_graph_image(self.bhszd_graph)
+            self.bhszd_graph_image=self._create_graph_image(self.bhszd_graph.to_networkx())
 
     
     def _create_graph_image(self,graph):
@@ -42,35 +51,12 @@ class NodeGraph:
         return self._draw_graph(graph, pos, edge_colors, edge_labels)
 
 
-    def _custom_edge_weight(self,bhszd:BHSzD):
-        stamp_type_multiplier = {
-            StampType.Digital.value:1,
-            StampType.Kezi.value:100000000,
-            StampType.DB.value:999999999999999999999999999
-        }
-        stamp_type = bhszd.stamp_type 
-        stamp_time = bhszd.stamping_date
-        if stamp_type == StampType.DB:
-            return stamp_type_multiplier[StampType.DB.value]
-        elif stamp_type == StampType.Kezi:
-            day_diff = abs((self.current_time - stamp_time).total_seconds())/60
-            if bhszd.bh_szakasz.end_date is None:
-                return stamp_type_multiplier[StampType.Kezi.value]+day_diff
-            else:
-                return stamp_type_multiplier[StampType.Kezi.value]+day_diff
-        else:
-            day_diff = abs((self.current_time - stamp_time).total_seconds())/60
-            if bhszd.bh_szakasz.end_date is None:
-                return stamp_type_multiplier[StampType.Digital.value]+day_diff
-            else:
-                return stamp_type_multiplier[StampType.Digital.value]+day_diff
-
     def validate_mozgalom(self):
-        self.best_path:List[BHSzD] = self.custom_dijkstra_path(self.bhszd_graph, self.kezdopont, self.vegpont, weight="weight")
-        self.validated_graph= nx.MultiDiGraph()
-        for bhszd in self.best_path:
-            self.validated_graph.add_edge(bhszd.bh_szakasz.kezdopont_bh_id,bhszd.bh_szakasz.vegpont_bh_id,BHSzD=bhszd)
+        self.best_path:List[BHSzD] = self.bhszd_graph.shortest_path(self.kezdopont, self.vegpont)
         if self.testing:
+            self.validated_graph= nx.MultiDiGraph()
+            for bhszd in self.best_path:
+                self.validated_graph.add_edge(bhszd.bh_szakasz.kezdopont_bh_id,bhszd.bh_szakasz.vegpont_bh_id,BHSzD=bhszd)
             self.validated_graph_image = self._create_graph_image(self.validated_graph)
         self._group_bhszd_by_nagyszakasz()
 
@@ -80,6 +66,7 @@ class NodeGraph:
         nagyszakasz_db = {}
         for bhszd in self.best_path:
             if bhszd.stamp_type != StampType.DB:
+                self.stamped_path.append(bhszd)
                 value = nagyszakasz_bhszds.get(bhszd.bh_szakasz.nagyszakasz_id, None)
                 if not value:
                     nagyszakasz_bhszds[bhszd.bh_szakasz.nagyszakasz_id] = []
@@ -95,49 +82,39 @@ class NodeGraph:
                     else:
                         value.append(bhszd)
         self.all_nagyszakasz = len(nagyszakasz_db.keys())
+        stamped_runs = self._stamped_nagyszakasz_runs()
         for key,value in nagyszakasz_bhszds.items():
-            custom_nagyszakasz = CustomNagyszakasz(value,key)
-            nagyszakasz_graph = nx.MultiDiGraph()
-            for edge in custom_nagyszakasz.bhszds:
-                nagyszakasz_graph.add_edge(edge.bh_szakasz.kezdopont_bh_id,edge.bh_szakasz.vegpont_bh_id,BHSzD=edge, weight=1)
-            try:
-                path = self.custom_dijkstra_path(nagyszakasz_graph,custom_nagyszakasz.db_nagyszakasz.kezdopont_bh_id, custom_nagyszakasz.db_nagyszakasz.vegpont_bh_id,weight="weight")
-                if path:
-                    self.completed_nagyszakasz+=1
-            except:
-                pass
-
-    def custom_dijkstra_path(self, graph, source, target, weight="weight"):
-        queue = [(0, source, [], [])]  
-        visited = set()
-
-        while queue:
-            (cost, u, path, edge_used) = heapq.heappop(queue)
-
-            if u in visited:
-                continue
-            visited.add(u)
-
-            path = path + [u]
-
-            if u == target:
-                return edge_used 
-
-            for v, edge_data in graph[u].items():
-                min_edge_weight = float('inf')
-                best_bhszd = None
-                for edge_key, edge in edge_data.items():
-                    edge_weight = edge.get(weight, float('inf'))
-                    if edge_weight < min_edge_weight:
-                        min_edge_weight = edge_weight
-                        best_bhszd = edge["BHSzD"]
-
-                if v not in visited and best_bhszd:
-                    new_edge_used = edge_used + [best_bhszd]
-                    heapq.heappush(queue, (cost + min_edge_weight, v, path, new_edge_used))
-
-        return None
+            custom_nagyszakasz = CustomNagyszakasz(value,key,self.nagyszakasz_index)
+            db_nagyszakasz = custom_nagyszakasz.db_nagyszakasz
+            if db_nagyszakasz and self._runs_cover(stamped_runs.get(key, []), db_nagyszakasz.kezdopont_bh_id, db_nagyszakasz.vegpont_bh_id):
+                self.completed_nagyszakasz+=1
 
+    def _stamped_nagyszakasz_runs(self):
+        """
+        The unbroken runs of stamped sections of each nagyszakasz along the best path, as bh_id sequences.
+        The best path is a simple directed path, so the stamped sections of a nagyszakasz connect its start
+        to its end exactly when one of its runs passes the start before the end.
+        """
+        runs = {}
+        run_id, run = None, None
+        for bhszd in self.best_path:
+            if bhszd.stamp_type == StampType.DB:
+                run = None
+                continue
+            nagyszakasz_id = bhszd.bh_szakasz.nagyszakasz_id
+            if run is None or run_id != nagyszakasz_id or run[-1] != bhszd.bh_szakasz.kezdopont_bh_id:
+                run_id, run = nagyszakasz_id, [bhszd.bh_szakasz.kezdopont_bh_id]
+                runs.setdefault(nagyszakasz_id, []).append(run)
+            run.append(bhszd.bh_szakasz.vegpont_bh_id)
+        return runs
+
+    @staticmethod
+    def _runs_cover(runs, start: str, end: str) -> bool:
+        for run in runs:
+            positions = {bh_id: position for position, bh_id in enumerate(run)}
+            if start in positions and end in positions and positions[start] < positions[end]:
+                return True
+        return False
 
     def extract_parts(self,bh_id: str) -> int:
         """Extract relevant parts based on mozgalom."""
@@ -159,52 +136,26 @@ class NodeGraph:
         vegpont_key = self.extract_parts(bhszd.bh_szakasz.vegpont_bh_id, self.mozgalom)
         return (kezdopont_key, vegpont_key)
 
-    def _build_graph(self, bhszd_sections) -> nx.MultiDiGraph:
+    def _build_graph(self, bhszd_sections) -> OverlayGraph:
         """
-        Creates and populates the directed graph dynamically by updating the cached graph
-        and adding new, validated BHSzD sections.
+        Creates the request graph as an overlay over the cached graph, replacing its DB edges
+        with the new, validated BHSzD sections without copying the cached graph.
         """
-        # Retrieve cached graph for the current 'mozgalom'
-        from challenges.task import get_graph_cache
-        cached_graph: nx.MultiDiGraph = get_graph_cache(self.mozgalom)
-
-        # Create a new graph to work with
-        graph = nx.MultiDiGraph()
-        if cached_graph:
-            graph = cached_graph.copy()
-        
-        cached_nodes = set(graph.nodes)
+        # The cached graph of the current 'mozgalom', from the snapshot the request pinned
+        graph = OverlayGraph(self.cached_graph)
 
         for bhszd in bhszd_sections:
             start = bhszd.bh_szakasz.kezdopont_bh_id
             end = bhszd.bh_szakasz.vegpont_bh_id
-            edge_weight = int(self._custom_edge_weight(bhszd))
-
-            # Remove existing edges between these nodes to replace them with validated BHSzD
-            edges_to_remove = [
-                (u, v, key) for u, v, key, data in graph.edges(keys=True, data=True)
-                if u == start and v == end and data["BHSzD"].stamp_type == StampType.DB
-            ]
-            if edges_to_remove:
-                graph.remove_edges_from(edges_to_remove)
-
-            # Add missing nodes
-            if start not in cached_nodes:
-                graph.add_node(start)
-                cached_nodes.add(start)
-            if end not in cached_nodes:
-                graph.add_node(end)
-                cached_nodes.add(end)
+            edge_weight = self.cost_model.cost(bhszd)
+
+            # Hide existing DB edges between these nodes to replace them with validated BHSzD
+            graph.remove_db_edges(start, end)
 
             # Add the new validated edge
-            graph.add_edge(start, end, BHSzD=bhszd, weight=edge_weight)
+            graph.add_edge(start, end, bhszd, edge_weight)
         return graph
 
-
-
-
-
-
     def _get_node_positions(self, graph: nx.MultiDiGraph) -> dict:
         """Generates positions for each node, arranging them in an alternating snake-like row layout with staggered end nodes if necessary."""
         pos = {}
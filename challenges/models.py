@@ -1,9 +1,25 @@
 from datetime import datetime
-from typing import List
+from typing import Dict, Iterable, List, Optional, Tuple
 from django.db import models
 from django.db.models import Q
 from rest_framework import exceptions
+from challenges.cache_index import BHPontIndex, NagySzakaszIndex, TuramozgalomIndex
 from challenges.enums import BookletTypes, DirectionType, StampType
+from challenges.records import BHRecord, BHSzakaszRecord
+
+
+def _valid_at(row, moment: datetime) -> bool:
+    '''start_date <= moment AND (end_date >= moment OR end_date IS NULL), evaluated on a fetched row'''
+    return row.start_date is not None and row.start_date <= moment and (row.end_date is None or row.end_date >= moment)
+
+
+def _single_match(model, matches: list):
+    '''The one row of `matches`, None for no row and MultipleObjectsReturned for more, like QuerySet.get()'''
+    if len(matches) > 1:
+        raise model.MultipleObjectsReturned(
+            f"get() returned more than one {model.__name__} -- it returned {len(matches)}!"
+        )
+    return matches[0] if matches else None
 
 
 class BHDList(list):
@@ -62,13 +78,13 @@ class BH(models.Model):
         managed = False  
 
     @staticmethod
-    def get_mozgalom_start_end_BH(bhd_list:BHDList, mozgalom:BookletTypes)-> str:
-        min_date:datetime = bhd_list.get_min_stamping_date()
-        max_date:datetime = bhd_list.get_max_stamping_date()
+    def get_mozgalom_start_end_BH(mozgalom:BookletTypes, turamozgalom_index:TuramozgalomIndex)-> str:
+        '''
+        Start and end point of the trail from the cached turamozgalom versions.
+        As in get_mozgalmak_versions_in_interval, whose date filter is disabled, every version of the trail counts.'''
         kezdopont = None
         vegpont = None
-        turamozgalom_db = Turamozgalom()
-        turamozgalom_versions = turamozgalom_db.get_mozgalmak_versions_in_interval(min_date, max_date, mozgalom)
+        turamozgalom_versions = turamozgalom_index.records(mozgalom)
         distinct_kezdopont = set()
         distinct_vegpont = set()
 
@@ -92,36 +108,37 @@ class BH(models.Model):
         ).first()
 
     @staticmethod
-    def create_BH_from_request(json_stamp:dict,bh_cache:dict,timestamp: datetime):
+    def create_BHs_from_request(json_stamps:List[dict],bh_index:BHPontIndex,timestamps:List[datetime]):
         '''
-        With the POST request data, get the BH from the DB.
+        Resolve every stamp of a request at once with the BHPONT index, then the index misses together
+        with one DB query, written back to the request's (mtsz_id, timestamp) resolution map.
         Database versioning starts from 2000-01-01, so converting lower date up to that'''
-        if timestamp < datetime(2000, 1, 1):
-            timestamp = datetime(2000, 1, 1)
-
-        bh_match = next(
-        (
-            bh for bh in bh_cache
-            if bh['mtsz_id'] == json_stamp.get('stampPointId')
-            and bh['start_date'] <= timestamp
-            and (bh['end_date'] is None or bh['end_date'] >= timestamp)
-        ),
-        None
-    )
-
-        if bh_match:
-            return BH(**bh_match)  # Rehydrate the BH object from the cache data
-
-        else:
-            try:
-                bh:BH = BH.objects.get(
-                    Q(mtsz_id=json_stamp.get('stampPointId')),
-                    Q(start_date__lte=timestamp),
-                    Q(end_date__gte=timestamp) | Q(end_date__isnull=True)
-                )
-                return bh
-            except BH.DoesNotExist:
-                print(exceptions.ValidationError(f"No BHPoint found for mtsz_id {json_stamp.get('stampPointId')} at {timestamp}"))
+        lookups = [
+            (json_stamp.get('stampPointId'), max(timestamp, datetime(2000, 1, 1)))
+            for json_stamp, timestamp in zip(json_stamps, timestamps)
+        ]
+        resolved = dict(zip(lookups, bh_index.resolve_many(lookups)))
+        misses = [lookup for lookup, bh_match in resolved.items() if bh_match is None]
+        if misses:
+            resolved.update(BH.get_many_from_DB(misses))
+        return [resolved[lookup] for lookup in lookups]
+
+    @staticmethod
+    def get_many_from_DB(lookups:Iterable[Tuple[str, datetime]]) -> Dict[Tuple[str, datetime], Optional["BH"]]:
+        '''
+        The BH valid at the timestamp of each (mtsz_id, timestamp) lookup, fetching the versions of every
+        mtsz_id in a single query and matching them in memory'''
+        lookups = list(dict.fromkeys(lookups))
+        versions: Dict[str, List[BH]] = {}
+        for bh in BH.objects.filter(mtsz_id__in={mtsz_id for mtsz_id, _ in lookups}):
+            versions.setdefault(bh.mtsz_id, []).append(bh)
+        resolved = {}
+        for mtsz_id, timestamp in lookups:
+            bh = _single_match(BH, [bh for bh in versions.get(mtsz_id, []) if _valid_at(bh, timestamp)])
+            if bh is None:
+                print(exceptions.ValidationError(f"No BHPoint found for mtsz_id {mtsz_id} at {timestamp}"))
+            resolved[(mtsz_id, timestamp)] = bh
+        return resolved
     
     def __str__(self):
         return f"{self.objectid}: {self.ver_id} {self.bh_nev} s_date:{self.start_date}, e_date: {self.end_date}, {self.mtsz_id}, {self.bh_id}"
@@ -191,15 +208,24 @@ class BHSzakasz(models.Model):
         return bhszakasz
 
     @staticmethod
-    def get_from_DB(start_BHD,end_BHD,section_date,mozgalom):
-        return BHSzakasz.objects.get((
-                (Q(kezdopont_bh_id=start_BHD.bh.bh_id) & Q(vegpont_bh_id=end_BHD.bh.bh_id)) |
-                (Q(kezdopont_bh_id=end_BHD.bh.bh_id) & Q(vegpont_bh_id=start_BHD.bh.bh_id))
-            ) &
-            Q(start_date__lte=section_date) &
-            (Q(end_date__gte=section_date) | Q(end_date__isnull=True)) &
-            Q(okk_mozgalom=mozgalom)
-        )
+    def get_many_from_DB(pairs:List[Tuple[str, str, datetime]], mozgalom:str) -> List[Optional["BHSzakasz"]]:
+        '''
+        The section between the two points of each (bh_id, bh_id, section_date) pair valid at its date, in either
+        direction, None where there is none. The sections among all the points are fetched in a single query.
+        '''
+        bh_ids = {bh_id for start, end, _ in pairs for bh_id in (start, end)}
+        sections: Dict[frozenset, List[BHSzakasz]] = {}
+        for bh_szakasz in BHSzakasz.objects.filter(
+            Q(kezdopont_bh_id__in=bh_ids) & Q(vegpont_bh_id__in=bh_ids) & Q(okk_mozgalom=mozgalom)
+        ):
+            sections.setdefault(frozenset((bh_szakasz.kezdopont_bh_id, bh_szakasz.vegpont_bh_id)), []).append(bh_szakasz)
+        return [
+            _single_match(BHSzakasz, [
+                bh_szakasz for bh_szakasz in sections.get(frozenset((start, end)), [])
+                if _valid_at(bh_szakasz, section_date)
+            ])
+            for start, end, section_date in pairs
+        ]
     
     @staticmethod
     def get_actual_version_from_DB(start_bh:str,mozgalom:str):
@@ -263,8 +289,8 @@ class Turamozgalom(models.Model):
 
 class BHD:
     '''Extending BH with properties and methods to validate Stamps'''
-    def __init__(self,bh:BH, timestamp:datetime=None,stamp_type:StampType=None) -> None:
-        self.bh:BH = bh
+    def __init__(self,bh:BH|BHRecord, timestamp:datetime=None,stamp_type:StampType=None) -> None:
+        self.bh:BH|BHRecord = bh
         self.stamping_date:datetime = timestamp
         self.stamp_type:StampType = stamp_type
         # self.neighbour_prev:BHD|None =None
@@ -283,29 +309,19 @@ class BHD:
         return bhd
 
     @staticmethod
-    def create_bhd_from_bh_id(bh_id:str, bh_cache:dict=None):
-        if bh_cache:
-            bh_match = next(
-            (
-                bh for bh in bh_cache
-                if bh['bh_id'] == bh_id
-                and bh['end_date'] is None)
-            )
-
-            if bh_match:
-                return BHD(bh=BH(**bh_match),timestamp=None,stamp_type=StampType.DB)  
-
-        else:
-
-            bh:BH = BH.get_actual_BH_from_bh_id(bh_id)
-            return BHD(bh,timestamp=None,stamp_type=StampType.DB)
+    def create_bhd_from_bh_id(bh_id:str, bh_cache:Dict[str, BHRecord]=None):
+        '''Current version of a point as a DB stamp, from a bh_id -> current point map if given, else from the DB'''
+        bh_match = bh_cache.get(bh_id) if bh_cache else None
+        if bh_match is None:
+            bh_match = BH.get_actual_BH_from_bh_id(bh_id)
+        return BHD(bh=bh_match,timestamp=None,stamp_type=StampType.DB)
 
     def __repr__(self) -> str:
         return (f"BHD with ID:{self.bh.bh_id}, {self.bh.ver_id} MTSZ_ID: {self.bh.mtsz_id}, NEV: {self.bh.bh_nev}, Time: {self.stamping_date}, Type: {self.stamp_type}")
 
 class BHSzD:
-    def __init__(self, bh_szakasz:BHSzakasz, validation_time:datetime=None, stamp_type: StampType=None, mozgalom: BookletTypes=None,kezdopont:BHD=None, vegpont:BHD=None, direction:DirectionType=DirectionType.Unknown,speed=None ) -> None:
-        self.bh_szakasz:BHSzakasz = bh_szakasz
+    def __init__(self, bh_szakasz:BHSzakasz|BHSzakaszRecord, validation_time:datetime=None, stamp_type: StampType=None, mozgalom: BookletTypes=None,kezdopont:BHD=None, vegpont:BHD=None, direction:DirectionType=DirectionType.Unknown,speed=None ) -> None:
+        self.bh_szakasz:BHSzakasz|BHSzakaszRecord = bh_szakasz
         self.stamping_date :datetime = validation_time
         self.stamp_type:StampType = stamp_type
         self.mozgalom:BookletTypes =mozgalom
@@ -324,28 +340,16 @@ class BHSzD:
         return f"BHSzD with ID:{self.bh_szakasz.bhszakasz_id},{self.bh_szakasz.ver_id} Szakasz: {self.bh_szakasz} KezdoBH: {self.kezdopont.bh.bh_id} at {self.kezdopont.stamping_date}, VEGBH: {self.vegpont.bh.bh_id} at {self.vegpont.stamping_date}, Time: {self.stamping_date}, {self.stamp_type}, {self.mozgalom}, {self.direction}, {self.speed}km/h, {self.time} minutes"
 
 class CustomNagyszakasz(NagySzakasz):
-    def __init__(self, bhszds:List[BHSzD],id:str,*args, **kwargs):
+    def __init__(self, bhszds:List[BHSzD],id:str,nagyszakasz_index:NagySzakaszIndex,*args, **kwargs):
         super().__init__(*args, **kwargs)
         self.id = id
         self.bhszds = bhszds
         self.min_date, self.max_date = self._get_time_interval()
-        self.db_nagyszakasz = self.get_Nagyszakasz_from_db()
+        self.db_nagyszakasz = nagyszakasz_index.covering(self.id, self.min_date, self.max_date)
 
     def _get_time_interval(self):
         return min(bhszd.stamping_date for bhszd in self.bhszds), max(bhszd.stamping_date for bhszd in self.bhszds)
     
 
-    def get_Nagyszakasz_from_db(self):
-        if isinstance(self.min_date, datetime):
-            self.min_date = self.min_date.isoformat()
-        if isinstance(self.max_date, datetime):
-            self.max_date = self.max_date.isoformat()
-        try:
-            return NagySzakasz.objects.filter(
-                nagyszakasz_id=self.id,
-            start_date__lte=self.min_date,
-            ).filter(Q(end_date__gte=self.max_date) | Q(end_date__isnull=True)).order_by('end_date').first()
-        except NagySzakasz.DoesNotExist:
-            return None
     def __repr__(self):
         return f"CUSTOM Nagyszakasz: {len(self.bhszds)} elemmel, min date:{self.min_date}, max date:{self.max_date}, Nagyszakasz: {self.db_nagyszakasz}"
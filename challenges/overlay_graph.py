@@ -0,0 +1,144 @@
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+
+from challenges.compiled_graph import CompiledTrailGraph
+from challenges.cost_model import is_db_cost
+from challenges.shortest_path import ShortestPathEngine, cheapest_parallel_edges, topological_order
+
+
+class OverlayGraph:
+    '''
+    Per-request view over a shared, read-only CompiledTrailGraph.
+    Only the edges the request hides or adds are stored, everything else reads through to the base graph,
+    so the cost of a request scales with the number of its sections instead of the size of the trail.
+    Nodes missing from the base graph get request-local ids after the base ones.
+    '''
+    def __init__(self, base: CompiledTrailGraph = None) -> None:
+        self._base: CompiledTrailGraph = base if base is not None else CompiledTrailGraph.empty()
+        self._added_nodes: Dict[str, int] = {}
+        self._masked: Set[int] = set()
+        self._added: Dict[int, List[Tuple[int, int, Any]]] = {}
+
+    @property
+    def nodes(self) -> List[str]:
+        return self._base.node_ids + list(self._added_nodes)
+
+    def node_id(self, node: str) -> Optional[int]:
+        node_id = self._base.node_id(node)
+        return node_id if node_id is not None else self._added_nodes.get(node)
+
+    def _intern(self, node: str) -> int:
+        node_id = self.node_id(node)
+        if node_id is None:
+            node_id = self._added_nodes[node] = self._base.num_nodes + len(self._added_nodes)
+        return node_id
+
+    def remove_db_edges(self, u: str, v: str) -> None:
+        '''Hide the cached DB edges between u and v by their CSR positions, only the row of u is read'''
+        u_id, v_id = self._base.node_id(u), self._base.node_id(v)
+        if u_id is None or v_id is None:
+            return
+        self._masked.update(
+            position for position, target, weight, bhszd in self._base.out_edges(u_id)
+            if target == v_id and is_db_cost(weight)
+        )
+
+    def add_edge(self, u: str, v: str, bhszd: Any, weight: int) -> None:
+        self._added.setdefault(self._intern(u), []).append((self._intern(v), weight, bhszd))
+
+    def out_edges(self, u: int) -> Iterable[Tuple[int, int, Any]]:
+        '''(v, weight, BHSzD) for the visible base edges of u followed by the request edges'''
+        for position, v, weight, bhszd in self._base.out_edges(u):
+            if position not in self._masked:
+                yield v, weight, bhszd
+        yield from self._added.get(u, ())
+
+    def neighbours(self, u: int) -> Iterable[Tuple[int, int, Any]]:
+        return cheapest_parallel_edges(self.out_edges(u))
+
+    def topological_order(self) -> Optional[List[int]]:
+        '''
+        The cached order of the base graph while the request edges follow it, otherwise a fresh
+        topological sort of the overlay, None when the request edges created a cycle.
+        '''
+        position = self._base.topological_position
+        if position is not None and not self._added_nodes and all(
+            position[u] < position[v] for u, edges in self._added.items() for v, _, _ in edges
+        ):
+            return self._base.topological_order.tolist()
+        return topological_order(len(self.nodes), self.out_edges)
+
+    def _path_along_chain(self, source_id: int, target_id: int) -> Optional[List[Any]]:
+        """
+        The cheapest path read off the base graph's TrailChain, touching only the request edges.
+        When every request edge steps one chain position forward, so does every edge of the overlay, and each path
+        from source to target takes one edge per position in between: the baseline DB path with the cheapest
+        request edge (first on ties, like cheapest_parallel_edges) in place of the DB section where there is one.
+        A masked link falls back to the cheapest of its parallel DB sections left visible.
+        Returns None when the chain does not apply or leaves no path, the full search decides then.
+        """
+        chain = self._base.chain
+        if chain is None or self._added_nodes:
+            return None
+        positions = chain.node_positions
+        first, last = int(positions[source_id]), int(positions[target_id])
+        if last <= first:
+            return None
+
+        steps: Dict[int, Tuple[int, Any]] = {}
+        for u, edges in self._added.items():
+            position = int(positions[u])
+            for v, weight, bhszd in edges:
+                if positions[v] != position + 1:
+                    return None
+                if first <= position < last and bhszd and (position not in steps or weight < steps[position][0]):
+                    steps[position] = (weight, bhszd)
+
+        path = chain.links[first:last]
+        weights = self._base.weights
+        link_edges: Dict[int, Optional[int]] = {}
+        for edge in self._masked:
+            position = int(positions[np.searchsorted(self._base.indptr, edge, side='right') - 1])
+            if first <= position < last and position not in link_edges:
+                visible = [edge for edge in chain.parallel_edges[position] if edge not in self._masked]
+                link_edges[position] = min(visible, key=weights.__getitem__) if visible else None
+                path[position - first] = (
+                    self._base.bhszds[int(self._base.sections[link_edges[position]])] if visible else None
+                )
+        for position, (weight, bhszd) in steps.items():
+            link_edge = link_edges.get(position, int(chain.link_edges[position]))
+            if link_edge is None or weight < int(weights[link_edge]):
+                path[position - first] = bhszd
+        return path if None not in path else None
+
+    def shortest_path(self, source: str, target: str) -> Optional[List[Any]]:
+        '''
+        BHSzD edges of the cheapest path between two bh_ids, read off the trail chain when the request follows it,
+        otherwise DAG relaxation unless the request made it cyclic
+        '''
+        source_id, target_id = self.node_id(source), self.node_id(target)
+        if source_id is None or target_id is None:
+            return None
+        path = self._path_along_chain(source_id, target_id)
+        if path is not None:
+            return path
+        engine = ShortestPathEngine(self.neighbours)
+        order = self.topological_order()
+        if order is not None:
+            return engine.dag_shortest_path(order, source_id, target_id)
+        return engine.shortest_path(source_id, target_id)
+
+    def to_networkx(self):
+        '''Materialize the overlay as a MultiDiGraph, only meant for the testing-mode images'''
+        import networkx as nx
+        nodes = self.nodes
+        graph = nx.MultiDiGraph()
+        graph.add_nodes_from(nodes)
+        for u in range(len(nodes)):
+            for position, v, weight, bhszd in self._base.out_edges(u):
+                if position not in self._masked:
+                    graph.add_edge(nodes[u], nodes[v], BHSzD=bhszd, weight=weight)
+        for u, edges in self._added.items():
+            for v, weight, bhszd in edges:
+                graph.add_edge(nodes[u], nodes[v], BHSzD=bhszd, weight=weight)
+        return graph
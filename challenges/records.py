@@ -0,0 +1,87 @@
+from dataclasses import dataclass, fields
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional
+
+
+def columns_of(record_type) -> List[str]:
+    '''The table columns a record type is loaded from, in load order'''
+    return [field.name for field in fields(record_type)]
+
+
+@dataclass(frozen=True, slots=True)
+class BHRecord:
+    '''
+    Immutable bhpont row handed out by the reference snapshot, shared by every request that resolves it.
+    Carries the columns validation and its serializers read.
+    '''
+    objectid: int
+    ver_id: Optional[int] = None
+    mtsz_id: Optional[str] = None
+    bh_id: Optional[str] = None
+    bh_nev: Optional[str] = None
+    lat: Optional[Decimal] = None
+    lon: Optional[Decimal] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+
+    def __str__(self):
+        return f"{self.objectid}: {self.ver_id} {self.bh_nev} s_date:{self.start_date}, e_date: {self.end_date}, {self.mtsz_id}, {self.bh_id}"
+
+
+@dataclass(frozen=True, slots=True)
+class BHSzakaszRecord:
+    '''Immutable bhszakasz row handed out by the reference snapshot, shared by every request and trail graph using it'''
+    objectid: int
+    ver_id: Optional[int] = None
+    nagyszakasz_id: Optional[str] = None
+    bhszakasz_id: Optional[str] = None
+    kezdopont: Optional[str] = None
+    vegpont: Optional[str] = None
+    szakasznev: Optional[str] = None
+    tav: Optional[Decimal] = None
+    szintemelkedes: Optional[int] = None
+    szintcsokkenes: Optional[int] = None
+    szintido_oda: Optional[str] = None
+    szintido_vissza: Optional[str] = None
+    gykt_tajegyseg: Optional[str] = None
+    okk_mozgalom: Optional[str] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+    kezdopont_bh_id: Optional[str] = None
+    vegpont_bh_id: Optional[str] = None
+
+    def __str__(self):
+        return f"{self.objectid}:{self.ver_id} {self.bhszakasz_id}, {self.szakasznev},{self.kezdopont_bh_id}/{self.kezdopont},{self.vegpont_bh_id}/{self.vegpont} at s_date:{self.start_date}, e_date: {self.end_date}"
+
+
+@dataclass(frozen=True, slots=True)
+class TuramozgalomRecord:
+    '''Immutable turamozgalom row handed out by the reference snapshot, the versions of a trail's start and end'''
+    objectid: int
+    okk_mozgalom: Optional[str] = None
+    nev: Optional[str] = None
+    kezdopont: Optional[str] = None
+    vegpont: Optional[str] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+
+    def __str__(self):
+        return self.nev
+
+
+@dataclass(frozen=True, slots=True, repr=False)
+class NagySzakaszRecord:
+    '''Immutable nagyszakasz row handed out by the reference snapshot, the boundary points of a main section version'''
+    objectid: int
+    nagyszakasz_id: Optional[str] = None
+    kezdopont: Optional[str] = None
+    kezdopont_bh_id: Optional[str] = None
+    vegpont: Optional[str] = None
+    vegpont_bh_id: Optional[str] = None
+    okk_mozgalom: Optional[str] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+
+    def __repr__(self):
+        return f"{self.nagyszakasz_id}, {self.kezdopont}, {self.vegpont}, {self.start_date}, {self.end_date}"
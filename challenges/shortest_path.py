@@ -0,0 +1,104 @@
+import heapq
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+Neighbours = Callable[[Hashable], Iterable[Tuple[Hashable, Any, Any]]]
+
+
+def cheapest_parallel_edges(edges: Iterable[Tuple[Hashable, Any, Any]]) -> Iterable[Tuple[Hashable, Any, Any]]:
+    '''Reduce the (v, weight, payload) parallel edges of a node to the cheapest one per v, the first one on ties'''
+    best: Dict[Hashable, Tuple[Any, Any]] = {}
+    for v, edge_weight, payload in edges:
+        if payload and (v not in best or edge_weight < best[v][0]):
+            best[v] = (edge_weight, payload)
+    return [(v, edge_weight, payload) for v, (edge_weight, payload) in best.items()]
+
+
+class ShortestPathEngine:
+    '''
+    Dijkstra keeping distance labels and predecessor edges instead of carrying the path in the heap.
+    The path is rebuilt once from the predecessors when the target is settled.
+    '''
+    def __init__(self, neighbours: Neighbours) -> None:
+        self.neighbours = neighbours
+        self.distance: Dict[Hashable, Any] = {}
+        self.predecessor: Dict[Hashable, Tuple[Hashable, Any]] = {}
+
+    def run(self, source: Hashable, target: Hashable = None) -> Dict[Hashable, Any]:
+        '''Settle nodes from source until target (or every reachable node) is settled, returns the distance labels'''
+        self.distance = {source: 0}
+        self.predecessor = {}
+        settled = set()
+        queue = [(0, source)]
+        while queue:
+            cost, u = heapq.heappop(queue)
+            if u in settled:
+                continue
+            settled.add(u)
+            if u == target:
+                break
+            for v, edge_weight, payload in self.neighbours(u):
+                if v in settled:
+                    continue
+                new_cost = cost + edge_weight
+                if v not in self.distance or new_cost < self.distance[v]:
+                    self.distance[v] = new_cost
+                    self.predecessor[v] = (u, payload)
+                    heapq.heappush(queue, (new_cost, v))
+        return self.distance
+
+    def run_dag(self, order: Iterable[Hashable], source: Hashable, target: Hashable = None) -> Dict[Hashable, Any]:
+        '''Relax the edges of an acyclic graph once in topological order, O(V+E) without a heap'''
+        self.distance = {source: 0}
+        self.predecessor = {}
+        for u in order:
+            if u not in self.distance:
+                continue
+            if u == target:
+                break
+            cost = self.distance[u]
+            for v, edge_weight, payload in self.neighbours(u):
+                new_cost = cost + edge_weight
+                if v not in self.distance or new_cost < self.distance[v]:
+                    self.distance[v] = new_cost
+                    self.predecessor[v] = (u, payload)
+        return self.distance
+
+    def path_to(self, source: Hashable, target: Hashable) -> Optional[List[Any]]:
+        '''Edge payloads from source to target following the predecessor edges, None if target was not reached'''
+        if target not in self.distance:
+            return None
+        path = []
+        node = target
+        while node != source:
+            node, payload = self.predecessor[node]
+            path.append(payload)
+        path.reverse()
+        return path
+
+    def shortest_path(self, source: Hashable, target: Hashable) -> Optional[List[Any]]:
+        self.run(source, target)
+        return self.path_to(source, target)
+
+    def dag_shortest_path(self, order: Iterable[Hashable], source: Hashable, target: Hashable) -> Optional[List[Any]]:
+        self.run_dag(order, source, target)
+        return self.path_to(source, target)
+
+
+def topological_order(num_nodes: int, out_edges: Callable[[int], Iterable[Tuple[int, Any, Any]]]) -> Optional[List[int]]:
+    '''Kahn's algorithm over nodes 0..num_nodes-1, None if the graph has a cycle'''
+    successors = [[edge[0] for edge in out_edges(u)] for u in range(num_nodes)]
+    indegree = [0] * num_nodes
+    for targets in successors:
+        for v in targets:
+            indegree[v] += 1
+    ready = [u for u in range(num_nodes) if indegree[u] == 0]
+    ready.reverse()
+    order = []
+    while ready:
+        u = ready.pop()
+        order.append(u)
+        for v in successors[u]:
+            indegree[v] -= 1
+            if indegree[v] == 0:
+                ready.append(v)
+    return order if len(order) == num_nodes else None
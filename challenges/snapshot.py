@@ -0,0 +1,167 @@
+from dataclasses import dataclass, field, fields, replace
+from functools import cached_property
+import os
+from threading import Event, Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+from django.conf import settings
+from django.core.cache import caches
+
+from challenges.cache_index import BHPontIndex, BHSzakaszIndex, NagySzakaszIndex, TuramozgalomIndex
+from challenges.column_table import ColumnTable
+from challenges.compiled_graph import CompiledTrailGraph
+from challenges.enums import WarmupState
+from challenges.snapshot_file import BuilderLock, SnapshotFile
+
+
+class ReferenceDataNotReady(Exception):
+    '''Raised when a request gave up waiting for the first reference snapshot'''
+    def __init__(self, state: WarmupState, retry_after: int) -> None:
+        super().__init__(f"Reference data is {state.value}")
+        self.state = state
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class ReferenceSnapshot:
+    '''
+    One consistent generation of the reference data: the bhpont/bhszakasz/turamozgalom/nagyszakasz tables,
+    their indexes and the trail graphs.
+    A request pins one snapshot for its whole lifetime, the listener builds the next one off to the side.
+    '''
+    generation: int = 0
+    # Fingerprint of the database tables the snapshot was loaded from, see task.reference_fingerprint
+    source_version: Tuple = ()
+    bhpont: ColumnTable = field(default_factory=ColumnTable)
+    bhpont_index: BHPontIndex = field(default_factory=BHPontIndex)
+    bhszakasz: ColumnTable = field(default_factory=ColumnTable)
+    bhszakasz_index: BHSzakaszIndex = field(default_factory=BHSzakaszIndex)
+    turamozgalom: ColumnTable = field(default_factory=ColumnTable)
+    turamozgalom_index: TuramozgalomIndex = field(default_factory=TuramozgalomIndex)
+    nagyszakasz: ColumnTable = field(default_factory=ColumnTable)
+    nagyszakasz_index: NagySzakaszIndex = field(default_factory=NagySzakaszIndex)
+    graphs: Dict[str, CompiledTrailGraph] = field(default_factory=dict)
+
+    def graph(self, trail: str) -> Optional[CompiledTrailGraph]:
+        return self.graphs.get(trail)
+
+    def draft(self) -> Dict[str, Any]:
+        '''The pieces of this snapshot as a dict to build the next generation from'''
+        return {piece.name: getattr(self, piece.name) for piece in fields(self) if piece.name != 'generation'}
+
+
+class SnapshotRegistry:
+    '''
+    Process-local holder of the current ReferenceSnapshot.
+    current() hands out the shared snapshot itself, nothing is pickled and no lock is taken, readers must treat
+    it as immutable. publish() swaps in the next generation with a single reference assignment.
+    With CHALLENGES_DISTRIBUTE_REFERENCE_CACHE enabled the Django cache backend of `cache_alias` is kept
+    in sync as a distribution layer, and a process without a snapshot of its own adopts the distributed one.
+    With CHALLENGES_SHARED_SNAPSHOT_DIR set (e.g. a /dev/shm directory) one worker per host holds the builder
+    lock and writes every generation to a SnapshotFile, the other workers map that file read-only instead of
+    building their own copy.
+    `state` tracks the warm-up: Cold until loading starts, Ready once a snapshot is served, Stale while the served
+    snapshot may be missing changes of the database.
+    '''
+    CACHE_KEY = 'REFERENCE_SNAPSHOT'
+
+    def __init__(self, cache_alias: str) -> None:
+        self.cache_alias = cache_alias
+        self._current = ReferenceSnapshot()
+        self._publish_lock = Lock()
+        self._shared_stamp = None
+        self.state = WarmupState.Cold
+        self._served = Event()
+
+    @property
+    def distributed(self) -> bool:
+        return getattr(settings, 'CHALLENGES_DISTRIBUTE_REFERENCE_CACHE', False)
+
+    @cached_property
+    def shared_directory(self) -> Optional[str]:
+        return getattr(settings, 'CHALLENGES_SHARED_SNAPSHOT_DIR', None)
+
+    @cached_property
+    def shared_file(self) -> Optional[SnapshotFile]:
+        if not self.shared_directory:
+            return None
+        return SnapshotFile(os.path.join(self.shared_directory, 'reference.snapshot'))
+
+    @cached_property
+    def _builder_lock(self) -> Optional[BuilderLock]:
+        if not self.shared_directory:
+            return None
+        return BuilderLock(os.path.join(self.shared_directory, 'builder.lock'))
+
+    def acquire_builder(self) -> bool:
+        '''True when this process builds the snapshots: sharing is off or it holds the host builder lock'''
+        return self._builder_lock is None or self._builder_lock.try_acquire()
+
+    def release_builder(self) -> None:
+        '''Give up the host builder lock, e.g. after a failed build, so another worker can take over'''
+        if self._builder_lock is not None:
+            self._builder_lock.release()
+
+    def shared_file_from_current_builder(self) -> bool:
+        '''True when the shared file was written since the live builder took the lock, not left by an earlier one'''
+        holder = self._builder_lock.holder() if self._builder_lock else None
+        stamp = self.shared_file.stamp() if self.shared_file else None
+        return holder is not None and stamp is not None and stamp[1] >= holder[1]
+
+    def refresh_from_shared_file(self, accept: Callable[[ReferenceSnapshot], bool] = None) -> bool:
+        '''
+        Attach to the shared snapshot file if the builder wrote a new generation since the last refresh.
+        A file that is not a snapshot, or is rejected by `accept`, is skipped until it is written again.
+        '''
+        stamp = self.shared_file.stamp() if self.shared_file else None
+        if stamp is None or stamp == self._shared_stamp:
+            return False
+        self._shared_stamp = stamp
+        snapshot = self.shared_file.attach()
+        if not isinstance(snapshot, ReferenceSnapshot) or (accept is not None and not accept(snapshot)):
+            return False
+        self._current = snapshot
+        self._mark_served()
+        return True
+
+    def current(self) -> ReferenceSnapshot:
+        snapshot = self._current
+        if snapshot.generation == 0 and self.distributed:
+            snapshot = caches[self.cache_alias].get(self.CACHE_KEY, snapshot)
+            self._current = snapshot
+            if snapshot.generation:
+                self._mark_served()
+        return snapshot
+
+    def mark(self, state: WarmupState) -> None:
+        self.state = state
+
+    def _mark_served(self) -> None:
+        self.state = WarmupState.Ready
+        self._served.set()
+
+    @property
+    def serving(self) -> bool:
+        return self.state in (WarmupState.Ready, WarmupState.Stale)
+
+    def wait_until_served(self, timeout: float, retry_after: int) -> ReferenceSnapshot:
+        '''The current snapshot, waiting at most `timeout` seconds for the first one to be published'''
+        self.current()
+        if self._served.wait(timeout):
+            return self.current()
+        raise ReferenceDataNotReady(self.state, retry_after)
+
+    def publish(self, **pieces) -> ReferenceSnapshot:
+        '''Stamp the pieces as the next generation, over the current snapshot, and make it current'''
+        with self._publish_lock:
+            snapshot = replace(self._current, generation=self._current.generation + 1, **pieces)
+            self._current = snapshot
+        self._mark_served()
+        if self.distributed:
+            caches[self.cache_alias].set(self.CACHE_KEY, snapshot)
+        if self.shared_file and self._builder_lock.held:
+            try:
+                self.shared_file.write(snapshot, snapshot.generation)
+            except OSError as e:
+                # The followers keep their previous generation, this process still serves the new one
+                print(f"Error writing the shared reference snapshot: {e}")
+        return snapshot
@@ -0,0 +1,167 @@
+import fcntl
+import io
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+from typing import Any, List, Optional, Tuple
+import numpy as np
+
+MAGIC = b'CHSNAP01'
+HEADER = struct.Struct('<8sqqq')
+ALIGNMENT = 64
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class _ArrayPickler(pickle.Pickler):
+    '''Pickles everything but NumPy arrays, which are only referenced and written raw after the pickle'''
+    def __init__(self, file) -> None:
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.arrays: List[np.ndarray] = []
+
+    def persistent_id(self, obj: Any):
+        if isinstance(obj, np.ndarray) and obj.dtype != object:
+            self.arrays.append(np.ascontiguousarray(obj))
+            return ('ndarray', len(self.arrays) - 1, obj.dtype.str, obj.shape)
+        return None
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    '''Resolves the array references to read-only views over the mapped file, nothing is copied'''
+    def __init__(self, file, buffer: mmap.mmap, offsets: List[int]) -> None:
+        super().__init__(file)
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def persistent_load(self, pid: Tuple):
+        _, index, dtype, shape = pid
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        return np.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.offsets[index]).reshape(shape)
+
+
+class SnapshotFile:
+    '''
+    Binary file holding one ReferenceSnapshot generation: a header, the pickled object part and the raw,
+    64-byte aligned NumPy arrays. Readers mmap the file, so the arrays are shared by every process of the host.
+    The file is replaced atomically, processes still mapping the previous one keep a valid view of it.
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def write(self, snapshot: Any, generation: int) -> None:
+        objects = io.BytesIO()
+        pickler = _ArrayPickler(objects)
+        pickler.dump(snapshot)
+        objects = objects.getvalue()
+
+        data_start = _aligned(HEADER.size + len(objects))
+        offsets, offset = [], data_start
+        for array in pickler.arrays:
+            offsets.append(offset)
+            offset = _aligned(offset + array.nbytes)
+        offsets_blob = pickle.dumps(offsets, protocol=pickle.HIGHEST_PROTOCOL)
+
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(HEADER.pack(MAGIC, generation, len(objects), len(offsets_blob)))
+                file.write(objects)
+                for array, array_offset in zip(pickler.arrays, offsets):
+                    file.seek(array_offset)
+                    file.write(array.tobytes())
+                file.seek(offset)
+                file.write(offsets_blob)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def stamp(self) -> Optional[Tuple[int, int]]:
+        '''Cheap identity of the file on disk, changes whenever a new generation is written'''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def attach(self) -> Optional[Any]:
+        '''Map the file read-only and rebuild the snapshot around the mapped arrays, None if there is no valid file'''
+        try:
+            with open(self.path, 'rb') as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            magic, _, objects_size, offsets_size = HEADER.unpack_from(buffer, 0)
+            if magic != MAGIC:
+                return None
+            offsets_start = len(buffer) - offsets_size
+            offsets = pickle.loads(buffer[offsets_start:])
+            objects = io.BytesIO(buffer[HEADER.size:HEADER.size + objects_size])
+            return _ArrayUnpickler(objects, buffer, offsets).load()
+        except Exception as e:
+            # A file left by another version of the code can fail to unpickle in many ways
+            print(f"Error attaching the snapshot file {self.path}: {e}")
+            return None
+
+
+class BuilderLock:
+    '''
+    Host-wide exclusive flock, the worker holding it is the only one building and publishing snapshots.
+    The holder writes its pid into the lock file, so the file's mtime tells when the current builder took over.
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        file = open(self.path, 'a')
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        file.truncate(0)
+        file.write(str(os.getpid()))
+        file.flush()
+        self._file = file
+        return True
+
+    def holder(self) -> Optional[Tuple[int, int]]:
+        '''Pid and take-over time (mtime in ns) of the live process holding the lock, None if it is gone'''
+        try:
+            with open(self.path) as file:
+                pid = int(file.read() or 0)
+                acquired = os.fstat(file.fileno()).st_mtime_ns
+        except (FileNotFoundError, ValueError):
+            return None
+        if pid <= 0:
+            return None
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+        return pid, acquired
+
+    def release(self) -> None:
+        if self._file is not None:
+            self._file.truncate(0)
+            self._file.close()
+            self._file = None
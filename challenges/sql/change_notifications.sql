@@ -0,0 +1,30 @@
+-- Change notifications read by challenges.task.listen_to_changes.
+-- Every changed row is announced on the channel of its table with the payload
+--   {"objectid": <objectid>, "operation": "INSERT" | "UPDATE" | "DELETE", "okk_mozgalom": <okk_mozgalom or null>}
+-- A payload without objectid makes the listener reload the whole table.
+-- bhpont_changes and bhszakasz_changes are already sent by the existing triggers of those tables, this installs
+-- the same contract for turamozgalom and nagyszakasz. Without it those two tables are only picked up by the
+-- periodic fingerprint recheck of the listener (TABLE_RECHECK_SECONDS).
+
+CREATE OR REPLACE FUNCTION kektura.notify_row_change() RETURNS trigger AS $$
+DECLARE
+    changed jsonb := to_jsonb(CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END);
+BEGIN
+    PERFORM pg_notify(TG_ARGV[0], json_build_object(
+        'objectid', changed -> 'objectid',
+        'operation', TG_OP,
+        'okk_mozgalom', changed -> 'okk_mozgalom'
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS turamozgalom_changes ON kektura.turamozgalom;
+CREATE TRIGGER turamozgalom_changes
+    AFTER INSERT OR UPDATE OR DELETE ON kektura.turamozgalom
+    FOR EACH ROW EXECUTE FUNCTION kektura.notify_row_change('turamozgalom_changes');
+
+DROP TRIGGER IF EXISTS nagyszakasz_changes ON kektura.nagyszakasz;
+CREATE TRIGGER nagyszakasz_changes
+    AFTER INSERT OR UPDATE OR DELETE ON kektura.nagyszakasz
+    FOR EACH ROW EXECUTE FUNCTION kektura.notify_row_change('nagyszakasz_changes');
@@ -1,8 +1,10 @@
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List, Set
+from decimal import Decimal
+from typing import Dict, List, Optional, Set
 from challenges.enums import DirectionType, StampType
 from challenges.models import BHD, BHDList, BHSzD
+from challenges.trail_chain import TrailChain
 from dateutil.relativedelta import relativedelta
 
 
@@ -31,10 +33,13 @@ class Statistic:
 
 
 class KekturaStatistics:
-    def __init__(self, validated_bhd:BHDList[BHD],validated_bhszd:List[BHSzD], best_path:List[BHSzD], completed_nagyszakasz:int, all_nagyszakasz:int, birth_year:int,gykt_already:int, mozgalom:str):
+    def __init__(self, validated_bhd:BHDList[BHD],validated_bhszd:List[BHSzD], best_path:List[BHSzD], completed_nagyszakasz:int, all_nagyszakasz:int, birth_year:int,gykt_already:int, mozgalom:str,
+                 stamped_path:List[BHSzD]=None, trail_chain:Optional[TrailChain]=None):
         self.validated_bhd = validated_bhd
         self.valid_bhszds = validated_bhszd
         self.best_path = best_path
+        self.stamped_path = stamped_path
+        self.trail_chain = trail_chain
         self.completed_main_section = completed_nagyszakasz
         self.all_main_section = all_nagyszakasz
         self.birth_year = birth_year
@@ -47,27 +52,14 @@ class KekturaStatistics:
 
 
     def calculate_statistics(self):
-        collected_stamps:Set[str] = set()
-        all_stamps:Set[str] = set()
         valid_bhszd_length = 0
         valid_bhszd_time = 0
-        completed_elevation = 0
-        all_elevation = 0
         start_date = self.validated_bhd.get_min_stamping_date()
         end_date = self.validated_bhd.get_max_stamping_date()
-        for path in self.best_path:
-            length =self._get_validated_length(path)
-            self._add_stamp_to_collection(path,all_stamps)
-            elevation = self._get_elevation(path)
-            all_elevation+=elevation
-            self.statistic_data.all_length +=length
-            
-            if path.stamp_type==StampType.DB:
-                self.statistic_data.remaining_length +=length
-            else:
-                self.statistic_data.completed_length += length
-                completed_elevation+=elevation
-                self._add_stamp_to_collection(path,collected_stamps)
+        path_totals = self._sum_path_on_chain()
+        if path_totals is None:
+            path_totals = self._sum_path()
+        all_elevation, completed_elevation, all_stamps, collected_stamps = path_totals
 
         for path in self.valid_bhszds:
             if path.stamp_type == StampType.Kezi:
@@ -100,6 +92,67 @@ class KekturaStatistics:
                     self.statistic_data.gykt_tajegyseg_data[bhszd.bh_szakasz.gykt_tajegyseg] = bhszd.bh_szakasz.tav
                     self.statistic_data.gykt_tajegyseg_data["mozgalom"] += bhszd.bh_szakasz.tav
 
+    def _sum_path(self):
+        '''Length, elevation and stamp totals of the best path, section by section'''
+        collected_stamps:Set[str] = set()
+        all_stamps:Set[str] = set()
+        completed_elevation = 0
+        all_elevation = 0
+        for path in self.best_path:
+            length =self._get_validated_length(path)
+            self._add_stamp_to_collection(path,all_stamps)
+            elevation = self._get_elevation(path)
+            all_elevation+=elevation
+            self.statistic_data.all_length +=length
+            
+            if path.stamp_type==StampType.DB:
+                self.statistic_data.remaining_length +=length
+            else:
+                self.statistic_data.completed_length += length
+                completed_elevation+=elevation
+                self._add_stamp_to_collection(path,collected_stamps)
+        return all_elevation, completed_elevation, len(all_stamps), len(collected_stamps)
+
+    def _sum_path_on_chain(self):
+        """
+        The totals of _sum_path from the trail chain's prefix sums, only visiting the stamped sections of the path.
+        When every stamped section joins consecutive chain positions, each section of the path steps one position
+        forward, so the path is the chain between its two ends with the stamped sections in place of the DB ones.
+        Returns None when the trail is not a chain or the path leaves it.
+        """
+        chain = self.trail_chain
+        if chain is None or self.stamped_path is None or not self.best_path:
+            return None
+        first = chain.position(self.best_path[0].bh_szakasz.kezdopont_bh_id)
+        last = chain.position(self.best_path[-1].bh_szakasz.vegpont_bh_id)
+        if first is None or last is None or last <= first:
+            return None
+
+        replaced_length = replaced_measured = replaced_climb = 0
+        completed_length = 0
+        completed_elevation = 0
+        collected_stamps:Set[str] = set()
+        for path in self.stamped_path:
+            start = chain.position(path.bh_szakasz.kezdopont_bh_id)
+            if start is None or chain.position(path.bh_szakasz.vegpont_bh_id) != start + 1:
+                return None
+            replaced_length += chain.length_between(start, start + 1)
+            replaced_measured += chain.measured_between(start, start + 1)
+            replaced_climb += chain.climb_between(start, start + 1)
+            completed_length += self._get_validated_length(path)
+            completed_elevation += self._get_elevation(path)
+            self._add_stamp_to_collection(path,collected_stamps)
+
+        # Decimal sums keep the decimal places of their terms, a path without any known length sums to int 0
+        remaining_length = 0
+        if chain.measured_between(first, last) - replaced_measured:
+            remaining_length = Decimal(chain.length_between(first, last) - replaced_length).scaleb(-chain.places)
+        self.statistic_data.remaining_length += remaining_length
+        self.statistic_data.completed_length += completed_length
+        self.statistic_data.all_length += remaining_length + completed_length
+        all_elevation = chain.climb_between(first, last) - replaced_climb + completed_elevation
+        return all_elevation, completed_elevation, last - first + 1, len(collected_stamps)
+
     def _calculate_date_datas(self,start_date:datetime, time_on_blue,end_date):
         time_diff = relativedelta(datetime.now(), start_date) if not self.statistic_data.mozgalom_completed else relativedelta(end_date,start_date)
         self.statistic_data.since_first_stamp_time_diff = {"years":time_diff.years, "months":time_diff.months, "days":time_diff.days}
@@ -162,7 +215,7 @@ class KekturaStatistics:
     def _get_validated_length(self, bhszd:BHSzD):
         return bhszd.bh_szakasz.tav if bhszd.bh_szakasz.tav is not None else 0
 
-    def _get_stamp_statistic(self,collected_stamps: Set[str], all_stamps: Set[str]):
-        self.statistic_data.completed_stamps = len(collected_stamps)
-        self.statistic_data.remaining_stamps = len(all_stamps)-len(collected_stamps)
+    def _get_stamp_statistic(self,collected_stamps: int, all_stamps: int):
+        self.statistic_data.completed_stamps = collected_stamps
+        self.statistic_data.remaining_stamps = all_stamps-collected_stamps
 
@@ -1,92 +1,490 @@
-from datetime import datetime, time
+from datetime import datetime
+import hashlib
 import re
 import psycopg2
 import select
+import time
 import json
 import yaml
+from threading import Thread
+from django.conf import settings
+from django.db import connections
 from challenges.cache_graph import build_cache_graph
-from challenges.enums import StampType
-from challenges.graph import NodeGraph
-from challenges.models import BH, BHD, BHSzD, BHSzakasz
-import networkx as nx
+from challenges.cache_index import BHPontIndex, BHSzakaszIndex, NagySzakaszIndex, TuramozgalomIndex
+from challenges.change_batch import ChangeBatch
+from challenges.column_table import NULL, ColumnTable, RecordMap
+from challenges.enums import StampType, WarmupState
+from challenges.models import BH, BHD, BHSzD, BHSzakasz, NagySzakasz, Turamozgalom
+from challenges.records import BHRecord, BHSzakaszRecord, NagySzakaszRecord, TuramozgalomRecord, columns_of
+from challenges.snapshot import ReferenceSnapshot, SnapshotRegistry
+from challenges.snapshot_file import SnapshotFile
 
-from django.core.cache import caches
+# Process-local reference data, the 'graph_memory' cache only distributes it
+reference_snapshots = SnapshotRegistry('graph_memory')
 
-# Use the 'bhpont_memory' cache
-bh_memory_cache = caches['bhpont_memory']
-szakasz_memory_cache = caches['bhszakasz_memory']
-graph_cache = caches['graph_memory']
+TRAILS = ['AK', 'OKT', 'RPDDK']
+# Notifications are coalesced into one rebuild per window
+NOTIFICATION_WINDOW_SECONDS = 2.0
+NOTIFICATION_WINDOW_SIZE = 500
+# Workers that are not the host's snapshot builder poll the shared snapshot file
+SHARED_SNAPSHOT_POLL_SECONDS = 1.0
+SHARED_SNAPSHOT_WAIT_SECONDS = 120.0
+# Requests arriving during warm-up wait this long for the first snapshot, then are told to retry
+REQUEST_WARMUP_WAIT_SECONDS = 10.0
+REQUEST_RETRY_AFTER_SECONDS = 5
+# A failed warm-up (e.g. the database is not reachable yet at boot) or a lost change listener connection
+# is retried with exponential backoff
+WARMUP_RETRY_SECONDS = 5.0
+WARMUP_RETRY_MAX_SECONDS = 300.0
+BH_ID_PREFIX_TRAILS = {'AKPH': 'AK', 'OKTPH': 'OKT', 'DDKPH': 'RPDDK'}
+# Reference tables with the column telling their last edit. nagyszakasz has none, its few rows are hashed instead
+FINGERPRINT_TABLES = [
+    (BH, 'last_edited_date'),
+    (BHSzakasz, 'last_edited_date'),
+    (Turamozgalom, 'last_edited_date'),
+    (NagySzakasz, None),
+]
+# Bump when the layout of the snapshot pieces changes, so persisted and shared snapshots of the old layout are rebuilt
+SNAPSHOT_FORMAT_VERSION = 10
+# turamozgalom and nagyszakasz are also compared to their fingerprint this often by the listener and reloaded
+# when they changed, so they stay fresh where their notification triggers (sql/change_notifications.sql) are missing
+TABLE_RECHECK_SECONDS = 60.0
+# Record type each reference table is loaded as
+RECORD_TYPES = {BH: BHRecord, BHSzakasz: BHSzakaszRecord, Turamozgalom: TuramozgalomRecord, NagySzakasz: NagySzakaszRecord}
+# Rows fetched per round trip of the server-side cursor
+LOAD_CHUNK_SIZE = 2000
 
 with open('routing_backend/config.yaml', 'r') as file:
     config = yaml.safe_load(file)
 
-def load_graph_cache():
-    """
-    Build and cache the graphs for AK, OKT, and DDK trails.
-    """
-    bhszakasz_cache = get_bhszakasz_cache()
-    bh_cache = get_bhpont_cache()
-    for trail in ['AK', 'OKT', 'RPDDK']:
-        current_bhszakasz = [
-            szakasz for szakasz in bhszakasz_cache 
-            if szakasz['okk_mozgalom'] == trail and szakasz['end_date'] is None
-        ]
-        bhszd_sections = [
-            BHSzD(
-                BHSzakasz(**szakasz),
-                validation_time=datetime.now(),  # Default validation time
-                mozgalom=trail,
-                stamp_type=StampType.DB,  # Default stamp type for this example
-                kezdopont=BHD.create_bhd_from_bh_id(szakasz['kezdopont_bh_id'], bh_cache),
-                vegpont=BHD.create_bhd_from_bh_id(szakasz['vegpont_bh_id'], bh_cache),
-            )
-            for szakasz in current_bhszakasz
-        ]
+def build_trail_graph(trail: str, bhszakasz_table: ColumnTable, bh_cache: dict):
+    """
+    Compile the graph of one trail from its current sections, resolving their end points in the bh_id map.
+    """
+    current_bhszakasz = bhszakasz_table.live_positions(
+        (bhszakasz_table.column('okk_mozgalom') == trail) & (bhszakasz_table.column('end_date') == NULL)
+    )
+    bhszd_sections = [
+        BHSzD(
+            szakasz,
+            validation_time=datetime.now(),  # Default validation time
+            mozgalom=trail,
+            stamp_type=StampType.DB,  # Default stamp type for this example
+            kezdopont=BHD.create_bhd_from_bh_id(szakasz.kezdopont_bh_id, bh_cache),
+            vegpont=BHD.create_bhd_from_bh_id(szakasz.vegpont_bh_id, bh_cache),
+        )
+        for szakasz in map(bhszakasz_table.record, current_bhszakasz.tolist())
+    ]
+    return build_cache_graph(bhszd_sections, trail, bh_cache)
+
+def load_graph_cache(draft: dict, trails=TRAILS):
+    """
+    Build the graphs for AK, OKT, and DDK trails, or only for the given ones, from the tables of a snapshot draft.
+    The trails share one bh_id -> current point map, which only materializes the points the graphs use.
+    """
+    bhpont_table = draft['bhpont']
+    bh_cache = RecordMap(bhpont_table, 'bh_id', bhpont_table.live_positions(bhpont_table.column('end_date') == NULL))
+
+    graphs = dict(draft['graphs'])
+    for trail in trails:
         try:
-            graph = build_cache_graph(bhszd_sections,trail)
-            graph_cache.set(f'{trail}_GRAPH', graph)
+            graphs[trail] = build_trail_graph(trail, draft['bhszakasz'], bh_cache)
         except Exception as e:
             print(f"Error building graph for {trail}: {e}")
+        print(f"Finished {trail} Graph",graphs.get(trail))
+    draft['graphs'] = graphs
+
+def load_table(model, record_type, index_type):
+    """
+    Stream the columns of `record_type` through a server-side cursor straight into the column arrays, one chunk
+    at a time, feeding the keys of every chunk to an `index_type` index in the same pass. Returns (table, index).
+    """
+    columns = columns_of(record_type)
+    rows = model.objects.values_list(*columns).iterator(chunk_size=LOAD_CHUNK_SIZE)
+    index = index_type()
+    table = ColumnTable.from_rows(
+        ColumnTable.schema_of(model, columns), record_type, rows, LOAD_CHUNK_SIZE,
+        lambda chunk, offset: index.add(chunk, range(offset, offset + len(chunk['objectid']))),
+    )
+    return table, index.finish(table)
+
+def load_bhszakasz_table(draft: dict):
+    """
+    Load the kektura.bhszakasz table and its index into a snapshot draft.
+    """
+    draft['bhszakasz'], draft['bhszakasz_index'] = load_table(BHSzakasz, BHSzakaszRecord, BHSzakaszIndex)
+
+def load_bhpont_table(draft: dict):
+    """
+    Load the `kektura.bhpont` table and its index into a snapshot draft.
+    """
+    draft['bhpont'], draft['bhpont_index'] = load_table(BH, BHRecord, BHPontIndex)
 
-        except Exception as main_exception:
-            print(f"Unexpected error processing trail {trail}: {main_exception}")
-    
-        print(f"Finished {trail} Graph",get_graph_cache(trail))
+def load_turamozgalom_table(draft: dict):
+    """
+    Load the `kektura.turamozgalom` table and its index into a snapshot draft.
+    """
+    draft['turamozgalom'], draft['turamozgalom_index'] = load_table(Turamozgalom, TuramozgalomRecord, TuramozgalomIndex)
 
-def get_graph_cache(trail: str) -> NodeGraph:
+def load_nagyszakasz_table(draft: dict):
     """
-    Retrieve the cached graph for a specific trail.
+    Load the `kektura.nagyszakasz` table and its index into a snapshot draft.
     """
-    return graph_cache.get(f'{trail}_GRAPH', None)
+    draft['nagyszakasz'], draft['nagyszakasz_index'] = load_table(NagySzakasz, NagySzakaszRecord, NagySzakaszIndex)
+
+# Loader of each fingerprinted reference table into a snapshot draft
+TABLE_LOADERS = {
+    BH: load_bhpont_table,
+    BHSzakasz: load_bhszakasz_table,
+    Turamozgalom: load_turamozgalom_table,
+    NagySzakasz: load_nagyszakasz_table,
+}
 
-def load_bhszakasz_table():
+def reload_table(draft: dict, source_version: list, model):
     """
-    Load the kektura.bhszakasz table into memory.
+    Reload one reference table into a snapshot draft and set its entry of `source_version` to the fingerprint
+    taken before its rows are read.
     """
+    index = [table for table, _ in FINGERPRINT_TABLES].index(model)
+    source_version[index + 1] = table_fingerprint(*FINGERPRINT_TABLES[index])
+    TABLE_LOADERS[model](draft)
 
-    rows = BHSzakasz.objects.all().values()
-    szakasz_memory_cache.set('BHSZAKASZ_CACHE', list(rows))
+def get_reference_snapshot() -> ReferenceSnapshot:
+    """
+    Retrieve the current reference snapshot, requests should keep using the one they got.
+    """
+    return reference_snapshots.current()
 
-def get_bhszakasz_cache():
+def reference_fingerprint():
     """
-    Retrieve the BHSZAKASZ_CACHE from memory.
+    Row count, highest objectid and last edit of the reference tables, it changes whenever the tables do.
+    A table without an edit column gets a hash of its loaded columns, so in-place edits change it too.
+    Taken before the rows are read, so a change racing the load makes the fingerprint stale, never too new.
     """
-    return szakasz_memory_cache.get('BHSZAKASZ_CACHE', [])
+    return (SNAPSHOT_FORMAT_VERSION, *(table_fingerprint(model, edited_column) for model, edited_column in FINGERPRINT_TABLES))
+
+def table_fingerprint(model, edited_column):
+    if edited_column is None:
+        return table_digest(model)
+    with connections[model.objects.db].cursor() as cursor:
+        cursor.execute(f"SELECT count(*), max(objectid), max({edited_column}) FROM {model._meta.db_table}")
+        return tuple(str(value) for value in cursor.fetchone())
 
-def load_bhpont_table():
+def table_digest(model):
     """
-    Load the `kektura.bhpont` table into the memory cache.
+    Row count and SHA-1 of the snapshot columns of a small table, read in objectid order.
     """
-    rows = BH.objects.all().values()
-    bh_memory_cache.set('BHPONT_CACHE', list(rows))
+    digest = hashlib.sha1()
+    count = 0
+    record_type = RECORD_TYPES[model]
+    for row in model.objects.order_by('objectid').values_list(*columns_of(record_type)).iterator(chunk_size=LOAD_CHUNK_SIZE):
+        digest.update(repr(row).encode())
+        count += 1
+    return (str(count), digest.hexdigest())
 
-def get_bhpont_cache():
+def persisted_snapshot_file():
     """
-    Retrieve the BHPONT_CACHE from memory.
+    The on-disk copy of the reference snapshot set by CHALLENGES_SNAPSHOT_PATH, None if persisting is off.
     """
-    return bh_memory_cache.get('BHPONT_CACHE', [])
+    path = getattr(settings, 'CHALLENGES_SNAPSHOT_PATH', None)
+    return SnapshotFile(path) if path else None
+
+def persist_reference_snapshot(snapshot: ReferenceSnapshot):
+    """
+    Write the snapshot to disk for the next cold start, a failed write only costs that start a full load.
+    """
+    snapshot_file = persisted_snapshot_file()
+    if snapshot_file is None:
+        return
+    try:
+        snapshot_file.write(snapshot, snapshot.generation)
+    except OSError as e:
+        print(f"Error persisting the reference snapshot: {e}")
+
+def load_persisted_snapshot(source_version):
+    """
+    The persisted reference snapshot if it was loaded from the same table versions, otherwise None.
+    """
+    snapshot_file = persisted_snapshot_file()
+    if snapshot_file is None:
+        return None
+    try:
+        snapshot = snapshot_file.attach()
+    except Exception as e:
+        print(f"Error reading the persisted reference snapshot: {e}")
+        return None
+    if not isinstance(snapshot, ReferenceSnapshot) or snapshot.source_version != source_version:
+        return None
+    return snapshot
+
+def wait_for_reference_snapshot() -> ReferenceSnapshot:
+    """
+    The current reference snapshot for a request, raises ReferenceDataNotReady if warm-up does not finish in time.
+    """
+    return reference_snapshots.wait_until_served(REQUEST_WARMUP_WAIT_SECONDS, REQUEST_RETRY_AFTER_SECONDS)
+
+def load_reference_snapshot() -> ReferenceSnapshot:
+    """
+    Load the reference tables and build every trail graph off to the side, then publish them as one generation.
+    A persisted snapshot of the same table versions is published instead of reloading.
+    """
+    started = time.perf_counter()
+    source_version = reference_fingerprint()
+    persisted = load_persisted_snapshot(source_version)
+    if persisted is not None:
+        snapshot = reference_snapshots.publish(**persisted.draft())
+        print(f"Loaded the persisted reference snapshot in {time.perf_counter() - started:.3f}s")
+        return snapshot
+
+    draft = get_reference_snapshot().draft()
+    draft['source_version'] = source_version
+    load_bhpont_table(draft)
+    load_bhszakasz_table(draft)
+    load_turamozgalom_table(draft)
+    load_nagyszakasz_table(draft)
+    load_graph_cache(draft)
+    snapshot = reference_snapshots.publish(**draft)
+    persist_reference_snapshot(snapshot)
+    print(f"Loaded the reference snapshot from the database in {time.perf_counter() - started:.3f}s")
+    return snapshot
+
+def warm_up():
+    """
+    Start the reference data in a background thread, the worker serves requests in the meantime.
+    """
+    reference_snapshots.mark(WarmupState.Loading)
+    Thread(target=_warm_up, daemon=True).start()
+
+def _warm_up():
+    delay = WARMUP_RETRY_SECONDS
+    while True:
+        try:
+            start_reference_data()
+            return
+        except Exception as e:
+            reference_snapshots.mark(WarmupState.Stale if reference_snapshots.serving else WarmupState.Cold)
+            print(f"Error warming up the reference data, retrying in {delay:.0f}s: {e}")
+        time.sleep(delay)
+        delay = min(delay * 2, WARMUP_RETRY_MAX_SECONDS)
+        if not reference_snapshots.serving:
+            reference_snapshots.mark(WarmupState.Loading)
+
+def start_reference_data():
+    """
+    The host's builder worker loads the reference data and listens to changes, publishing every generation
+    to the shared snapshot file. The other workers attach to that file and follow its generations, the first one
+    only once the current builder wrote it, so a file left by a previous deploy is not served.
+    A builder whose load fails gives up the builder lock for another worker to take over.
+    """
+    if reference_snapshots.acquire_builder():
+        try:
+            load_reference_snapshot()
+        except Exception:
+            reference_snapshots.release_builder()
+            raise
+        Thread(target=listen_to_changes, daemon=True).start()
+        return
+
+    waited = 0.0
+    while not reference_snapshots.refresh_from_shared_file(_written_by_current_builder) and waited < SHARED_SNAPSHOT_WAIT_SECONDS:
+        time.sleep(SHARED_SNAPSHOT_POLL_SECONDS)
+        waited += SHARED_SNAPSHOT_POLL_SECONDS
+    if get_reference_snapshot().generation == 0:
+        print("No shared reference snapshot appeared, loading a local one")
+        load_reference_snapshot()
+    Thread(target=follow_shared_snapshot, daemon=True).start()
+
+def _written_by_current_builder(snapshot: ReferenceSnapshot) -> bool:
+    return _current_format(snapshot) and reference_snapshots.shared_file_from_current_builder()
+
+def _current_format(snapshot: ReferenceSnapshot) -> bool:
+    return snapshot.source_version[:1] == (SNAPSHOT_FORMAT_VERSION,)
+
+def follow_shared_snapshot():
+    """
+    Remap the shared snapshot whenever the builder writes a new generation, and take over
+    building and listening if the builder worker goes away.
+    """
+    while True:
+        if not reference_snapshots.acquire_builder():
+            reference_snapshots.refresh_from_shared_file(_current_format)
+            time.sleep(SHARED_SNAPSHOT_POLL_SECONDS)
+            continue
+        print("Became the reference snapshot builder")
+        try:
+            load_reference_snapshot()
+        except Exception as e:
+            reference_snapshots.release_builder()
+            print(f"Error taking over the reference snapshot builder: {e}")
+            time.sleep(SHARED_SNAPSHOT_POLL_SECONDS)
+            continue
+        listen_to_changes()
+        return
+
+def parse_change_payload(payload: str):
+    """
+    Parse a `{"objectid": ..., "operation": ..., "okk_mozgalom": ...}` notification payload.
+    Returns None when the payload can not drive a delta update.
+    """
+    try:
+        change = json.loads(payload)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(change, dict) or change.get('objectid') is None:
+        return None
+    return change
+
+def _trails_of_bh_id(bh_id: str):
+    return {BH_ID_PREFIX_TRAILS[prefix] for prefix in re.findall(r"(AKPH|DDKPH|OKTPH)_\d+", bh_id or '')}
+
+def _apply_table_changes(draft: dict, name: str, model, changes):
+    """
+    Re-read the changed rows of one table in a single query and patch them into the table and index of a
+    snapshot draft, readers of the old table are not disturbed. Returns (change, old_row, new_row) per change.
+    """
+    table = draft[name]
+    upserted = [change['objectid'] for change in changes if change.get('operation') != 'DELETE']
+    record_type = table.record_type
+    new_rows = {
+        row['objectid']: record_type(**row)
+        for row in model.objects.filter(objectid__in=upserted).values(*columns_of(record_type))
+    }
+    patches = [(change, table.get(change['objectid']), new_rows.get(change['objectid'])) for change in changes]
+
+    removed = [table.position_of(change['objectid']) for change, old_row, _ in patches if old_row]
+    patched = table.patched(
+        removed=[change['objectid'] for change, old_row, _ in patches if old_row],
+        added=[new_row for _, _, new_row in patches if new_row],
+    )
+    added = [patched.position_of(new_row.objectid) for _, _, new_row in patches if new_row]
+    index = draft[f'{name}_index']
+    if patched.needs_compaction():
+        patched = patched.compacted()
+        draft[f'{name}_index'] = type(index).from_table(patched)
+    else:
+        draft[f'{name}_index'] = index.patched(patched, removed=removed, added=added)
+    draft[name] = patched
+    return patches
+
+def apply_bhpont_changes(draft: dict, changes):
+    """
+    Patch the changed bhpont rows into the table and index of a snapshot draft.
+    Returns the trails whose graph references one of the points.
+    """
+    patches = _apply_table_changes(draft, 'bhpont', BH, changes)
+    return set().union(*(
+        _trails_of_bh_id(row.bh_id) for _, old_row, new_row in patches for row in (old_row, new_row) if row
+    ))
+
+def apply_bhszakasz_changes(draft: dict, changes):
+    """
+    Patch the changed bhszakasz rows into the table and index of a snapshot draft.
+    Returns the trails whose current graph contains one of the sections before or after its change.
+    """
+    trails = set()
+    for change, old_row, new_row in _apply_table_changes(draft, 'bhszakasz', BHSzakasz, changes):
+        if old_row is None and new_row is None:
+            trails.add(change.get('okk_mozgalom'))
+        else:
+            trails.update(row.okk_mozgalom for row in (old_row, new_row) if row and row.end_date is None)
+    return trails & set(TRAILS)
+
+def apply_change_batch(batch: ChangeBatch):
+    """
+    Apply every change of a notification window to a draft of the current snapshot, rebuild each affected
+    trail graph once and publish the draft as the next generation.
+    Only reloaded tables get a new source_version entry. A delta-patched table keeps the entry of its last full
+    load, so the snapshot never claims table versions it does not hold and is not reused for them on a cold start.
+    """
+    started = time.perf_counter()
+    snapshot = get_reference_snapshot()
+    draft = snapshot.draft()
+    source_version = list(snapshot.source_version)
+    trails = set()
+    if 'bhpont_changes' in batch.full_reload:
+        reload_table(draft, source_version, BH)
+        trails.update(TRAILS)
+    if 'bhszakasz_changes' in batch.full_reload:
+        reload_table(draft, source_version, BHSzakasz)
+        trails.update(TRAILS)
+    if batch.changes.get('bhpont_changes'):
+        trails.update(apply_bhpont_changes(draft, list(batch.changes['bhpont_changes'].values())))
+    if batch.changes.get('bhszakasz_changes'):
+        trails.update(apply_bhszakasz_changes(draft, list(batch.changes['bhszakasz_changes'].values())))
+    if 'turamozgalom_changes' in batch.full_reload:
+        reload_table(draft, source_version, Turamozgalom)
+    if batch.changes.get('turamozgalom_changes'):
+        _apply_table_changes(draft, 'turamozgalom', Turamozgalom, list(batch.changes['turamozgalom_changes'].values()))
+    if 'nagyszakasz_changes' in batch.full_reload:
+        reload_table(draft, source_version, NagySzakasz)
+    if batch.changes.get('nagyszakasz_changes'):
+        _apply_table_changes(draft, 'nagyszakasz', NagySzakasz, list(batch.changes['nagyszakasz_changes'].values()))
+    load_graph_cache(draft, [trail for trail in TRAILS if trail in trails])
+    draft['source_version'] = tuple(source_version)
+    snapshot = reference_snapshots.publish(**draft)
+    persist_reference_snapshot(snapshot)
+    print(f"{datetime.now()} Merged {batch.received} notifications into {batch.merged} changes, "
+          f"rebuilt {sorted(trails)} in {time.perf_counter() - started:.3f}s, generation {snapshot.generation}")
+
+def reload_changed_tables(models):
+    """
+    Reload the given reference tables whose fingerprint moved away from their source_version entry into a new
+    generation, rebuilding the trail graphs when bhpont or bhszakasz was reloaded. Returns None if none moved.
+    """
+    snapshot = get_reference_snapshot()
+    source_version = list(snapshot.source_version)
+    draft = None
+    reloaded = []
+    for index, (model, edited_column) in enumerate(FINGERPRINT_TABLES, start=1):
+        if model not in models or index >= len(source_version):
+            continue
+        fingerprint = table_fingerprint(model, edited_column)
+        if fingerprint == source_version[index]:
+            continue
+        draft = draft if draft is not None else snapshot.draft()
+        TABLE_LOADERS[model](draft)
+        source_version[index] = fingerprint
+        reloaded.append(model)
+    if draft is None:
+        return None
+    if BH in reloaded or BHSzakasz in reloaded:
+        load_graph_cache(draft)
+    draft['source_version'] = tuple(source_version)
+    snapshot = reference_snapshots.publish(**draft)
+    persist_reference_snapshot(snapshot)
+    print(f"{datetime.now()} Reloaded changed {'/'.join(model._meta.db_table for model in reloaded)} rows, generation {snapshot.generation}")
+    return snapshot
+
+def recheck_unnotified_tables():
+    """
+    Reload turamozgalom and nagyszakasz into a new generation if their fingerprint moved without a notification.
+    Only their parts of the source_version are updated, the other tables are left to their notifications.
+    Change batches keep the entries of the tables they patched, so edits made before a batch are still found,
+    and a table patched by notifications is reloaded once to catch up its entry.
+    """
+    return reload_changed_tables((Turamozgalom, NagySzakasz))
 
 def listen_to_changes():
+    """
+    Apply the change notifications of the reference tables in batches, the payload each table's trigger sends
+    is described in sql/change_notifications.sql. While idle, turamozgalom and nagyszakasz are also rechecked
+    against their fingerprint. While the connection is lost the served snapshot no longer follows the database
+    and is reported stale, the listener reconnects with backoff and reloads the tables that moved meanwhile.
+    """
+    delay = WARMUP_RETRY_SECONDS
+    while True:
+        try:
+            _listen_to_changes()
+        except Exception as e:
+            # A listener that got back in sync before failing starts over with the shortest delay
+            if reference_snapshots.state == WarmupState.Ready:
+                delay = WARMUP_RETRY_SECONDS
+            reference_snapshots.mark(WarmupState.Stale)
+            print(f"Error listening to the reference table changes, reconnecting in {delay:.0f}s: {e}")
+        time.sleep(delay)
+        delay = min(delay * 2, WARMUP_RETRY_MAX_SECONDS)
+
+def _listen_to_changes():
     conn = psycopg2.connect(
         dbname=config['bh']['Name'],
         user=config['bh']['User'],
@@ -94,23 +492,35 @@ def listen_to_changes():
         host=config['DATABASE']['Host'],
         port=5432
     )
-    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-    cur = conn.cursor()
+    try:
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
 
-    cur.execute("LISTEN bhpont_changes;")
-    cur.execute("LISTEN bhszakasz_changes;")
-    print("Listening to `bhpont_changes` and `bhszakasz_changes` notifications...")
+        cur.execute("LISTEN bhpont_changes;")
+        cur.execute("LISTEN bhszakasz_changes;")
+        cur.execute("LISTEN turamozgalom_changes;")
+        cur.execute("LISTEN nagyszakasz_changes;")
+        print("Listening to `bhpont_changes`, `bhszakasz_changes`, `turamozgalom_changes` and `nagyszakasz_changes` notifications...")
+        # Changes made while no listener was connected are not notified again, reload the tables that moved
+        reload_changed_tables(TABLE_LOADERS)
+        reference_snapshots.mark(WarmupState.Ready)
 
-    while True:
-        if select.select([conn], [], [], 5) == ([], [], []):
-            continue
-        conn.poll()
-        while conn.notifies:
-            notify = conn.notifies.pop(0)
-            print(f"{datetime.now()} Notification received: {notify.payload}")
-
-            if notify.channel == 'bhpont_changes':
-                load_bhpont_table()
-            elif notify.channel == 'bhszakasz_changes':
-                load_bhszakasz_table()
-            load_graph_cache()
\ No newline at end of file
+        batch = ChangeBatch(NOTIFICATION_WINDOW_SECONDS, NOTIFICATION_WINDOW_SIZE)
+        rechecked_at = time.monotonic()
+        while True:
+            timeout = batch.remaining()
+            if select.select([conn], [], [], 5 if timeout is None else timeout) != ([], [], []):
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    print(f"{datetime.now()} Notification received: {notify.payload}")
+                    batch.add(notify.channel, parse_change_payload(notify.payload))
+
+            if batch.is_due():
+                apply_change_batch(batch)
+                batch = ChangeBatch(NOTIFICATION_WINDOW_SECONDS, NOTIFICATION_WINDOW_SIZE)
+            elif batch.empty and time.monotonic() - rechecked_at >= TABLE_RECHECK_SECONDS:
+                recheck_unnotified_tables()
+                rechecked_at = time.monotonic()
+    finally:
+        conn.close()
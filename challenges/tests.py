@@ -1,3 +1,696 @@
-from django.test import TestCase
+from datetime import datetime, timedelta
+from decimal import Decimal
+import os
+import tempfile
+from unittest import mock
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from challenges import task
+from challenges.cache_graph import build_cache_graph
+from challenges.cache_index import BHPontIndex, BHSzakaszIndex, NagySzakaszIndex
+from challenges.change_batch import ChangeBatch
+from challenges.column_table import ColumnTable
+from challenges.cost_model import DB_COST, TieredCostModel, is_db_cost
+from challenges.enums import DirectionType, StampType, WarmupState
+from challenges.models import BH, BHD, BHDList, BHSzakasz, BHSzD, NagySzakasz, Turamozgalom
+from challenges.overlay_graph import OverlayGraph
+from challenges.records import BHRecord, BHSzakaszRecord, NagySzakaszRecord, columns_of
+from challenges.shortest_path import ShortestPathEngine
+from challenges.snapshot import ReferenceSnapshot, SnapshotRegistry
+from challenges.snapshot_file import SnapshotFile
+from challenges.statistic import KekturaStatistics
+
+NOW = datetime(2024, 6, 1, 12, 0)
+POINTS = [f"OKTPH_{number}" for number in range(1, 11)]
+
+
+def make_table(model, record_type, records, **kwargs) -> ColumnTable:
+    columns = columns_of(record_type)
+    rows = [tuple(getattr(record, name) for name in columns) for record in records]
+    return ColumnTable.from_rows(ColumnTable.schema_of(model, columns), record_type, rows, **kwargs)
+
+
+def make_point(objectid: int, mtsz_id: str, start_date, end_date=None, **columns) -> BHRecord:
+    return BHRecord(**{
+        'objectid': objectid,
+        'ver_id': 1,
+        'mtsz_id': mtsz_id,
+        'bh_id': f"OKTPH_{objectid}",
+        'bh_nev': f"Pont {objectid}",
+        'lat': Decimal("47.5"),
+        'lon': Decimal("19.25"),
+        'start_date': start_date,
+        'end_date': end_date,
+        **columns,
+    })
+
+
+def make_section(number: int, **columns) -> BHSzakaszRecord:
+    '''The section from the number-th point of POINTS to the next one'''
+    return BHSzakaszRecord(**{
+        'objectid': number,
+        'bhszakasz_id': f"OKT_SZ_{number}",
+        'nagyszakasz_id': f"OKT_{(number + 2)//3}",
+        'kezdopont_bh_id': POINTS[number - 1],
+        'vegpont_bh_id': POINTS[number],
+        'tav': Decimal(f"{number}.25"),
+        'szintemelkedes': 10,
+        'szintcsokkenes': 5,
+        'szintido_oda': "1:30",
+        'szintido_vissza': "1:20",
+        'okk_mozgalom': "OKT",
+        **columns,
+    })
+
+
+class TrailChainFastPathTests(SimpleTestCase):
+    '''
+    The chain fast paths (`_path_along_chain`, `_sum_path_on_chain`) against the full search and section by section
+    sums, on a trail chain with stamped, DB and masked request edges and ties between parallel edges.
+    '''
+    def setUp(self):
+        self.bh_cache = {
+            bh_id: BHRecord(objectid=number, bh_id=bh_id, mtsz_id=f"M{number}")
+            for number, bh_id in enumerate(POINTS, start=1)
+        }
+        self.sections = [make_section(number) for number in range(1, len(POINTS))]
+        # Sections without a known length or climb, their stretch of the chain must not count as measured
+        self.sections[3] = make_section(4, tav=Decimal(0))
+        self.sections[6] = make_section(7, tav=None, szintemelkedes=None)
+        self.graph = build_cache_graph([self.db_bhszd(section) for section in self.sections], "OKT", self.bh_cache)
+        self.cost_model = TieredCostModel(NOW)
+
+    def db_bhszd(self, section: BHSzakaszRecord) -> BHSzD:
+        return BHSzD(
+            section, validation_time=NOW, mozgalom="OKT", stamp_type=StampType.DB,
+            kezdopont=BHD.create_bhd_from_bh_id(section.kezdopont_bh_id, self.bh_cache),
+            vegpont=BHD.create_bhd_from_bh_id(section.vegpont_bh_id, self.bh_cache),
+        )
+
+    def stamped_bhszd(self, section: BHSzakaszRecord, stamp_type: StampType, stamped: datetime) -> BHSzD:
+        return BHSzD(
+            section, validation_time=stamped, mozgalom="OKT", stamp_type=stamp_type,
+            kezdopont=BHD(self.bh_cache[section.kezdopont_bh_id], stamped - timedelta(hours=2), stamp_type),
+            vegpont=BHD(self.bh_cache[section.vegpont_bh_id], stamped, stamp_type),
+            direction=DirectionType.Forward,
+        )
+
+    def overlay(self, request_sections) -> OverlayGraph:
+        '''The request graph like NodeGraph._build_graph builds it'''
+        graph = OverlayGraph(self.graph)
+        for bhszd in request_sections:
+            start, end = bhszd.bh_szakasz.kezdopont_bh_id, bhszd.bh_szakasz.vegpont_bh_id
+            graph.remove_db_edges(start, end)
+            graph.add_edge(start, end, bhszd, self.cost_model.cost(bhszd))
+        return graph
+
+    def full_search(self, graph: OverlayGraph, source: str, target: str):
+        order = graph.topological_order()
+        return ShortestPathEngine(graph.neighbours).dag_shortest_path(order, graph.node_id(source), graph.node_id(target))
+
+    def mixed_request(self):
+        digital = self.stamped_bhszd(self.sections[0], StampType.Digital, NOW - timedelta(days=3))
+        register = self.stamped_bhszd(self.sections[2], StampType.Kezi, NOW - timedelta(days=1))
+        # A register and an older digital stamp of the same section, the digital tier wins
+        older_digital = self.stamped_bhszd(self.sections[3], StampType.Digital, NOW - timedelta(days=30))
+        newer_register = self.stamped_bhszd(self.sections[3], StampType.Kezi, NOW - timedelta(days=2))
+        # Two stamps of equal cost, the first one added wins
+        tie_first = self.stamped_bhszd(self.sections[5], StampType.Digital, NOW - timedelta(days=5))
+        tie_second = self.stamped_bhszd(self.sections[5], StampType.Digital, NOW - timedelta(days=5))
+        # A DB stamp of a section replaces its masked cached edge
+        db_stamp = self.db_bhszd(self.sections[7])
+        return [digital, register, newer_register, older_digital, tie_first, tie_second, db_stamp]
+
+    def test_chain_is_attached(self):
+        chain = self.graph.chain
+        self.assertIsNotNone(chain)
+        self.assertEqual(len(chain), len(POINTS))
+        self.assertEqual([chain.position(bh_id) for bh_id in POINTS], list(range(len(POINTS))))
+
+    def test_path_along_chain_matches_full_search(self):
+        request = self.mixed_request()
+        graph = self.overlay(request)
+        compared = 0
+        for first, source in enumerate(POINTS):
+            for target in POINTS[first + 1:]:
+                fast = graph._path_along_chain(graph.node_id(source), graph.node_id(target))
+                self.assertIsNotNone(fast)
+                self.assertEqual([id(bhszd) for bhszd in fast], [id(bhszd) for bhszd in self.full_search(graph, source, target)])
+                compared += 1
+        self.assertEqual(compared, len(POINTS)*(len(POINTS) - 1)//2)
+
+        path = graph.shortest_path(POINTS[0], POINTS[-1])
+        self.assertIs(path[3], request[3])
+        self.assertIs(path[5], request[4])
+        self.assertIs(path[7], request[6])
+        self.assertEqual(sum(1 for bhszd in path if bhszd.stamp_type == StampType.DB), 5)
+
+    def test_masked_edge_without_replacement(self):
+        graph = self.overlay(self.mixed_request())
+        graph.remove_db_edges(POINTS[4], POINTS[5])
+        self.assertIsNone(graph._path_along_chain(graph.node_id(POINTS[0]), graph.node_id(POINTS[-1])))
+        self.assertIsNone(self.full_search(graph, POINTS[0], POINTS[-1]))
+        self.assertIsNone(graph.shortest_path(POINTS[0], POINTS[-1]))
+        fast = graph._path_along_chain(graph.node_id(POINTS[5]), graph.node_id(POINTS[-1]))
+        self.assertEqual([id(bhszd) for bhszd in fast], [id(bhszd) for bhszd in self.full_search(graph, POINTS[5], POINTS[-1])])
+
+    def test_request_leaving_the_chain_falls_back(self):
+        shortcut = make_section(2, objectid=100, vegpont_bh_id=POINTS[4])
+        request = self.mixed_request() + [self.stamped_bhszd(shortcut, StampType.Digital, NOW - timedelta(days=1))]
+        graph = self.overlay(request)
+        self.assertIsNone(graph._path_along_chain(graph.node_id(POINTS[0]), graph.node_id(POINTS[-1])))
+        path = graph.shortest_path(POINTS[0], POINTS[-1])
+        self.assertEqual([id(bhszd) for bhszd in path], [id(bhszd) for bhszd in self.full_search(graph, POINTS[0], POINTS[-1])])
+        self.assertIs(path[1], request[-1])
+
+    def statistics(self, best_path, trail_chain) -> KekturaStatistics:
+        stamped_path = [bhszd for bhszd in best_path if bhszd.stamp_type != StampType.DB]
+        validated_bhd = BHDList(bhd for bhszd in stamped_path for bhd in (bhszd.kezdopont, bhszd.vegpont))
+        return KekturaStatistics(
+            validated_bhd, stamped_path, best_path, 1, 3, 1990, True, "OKT",
+            stamped_path=stamped_path, trail_chain=trail_chain,
+        )
+
+    def test_sum_path_on_chain_matches_sum_path(self):
+        graph = self.overlay(self.mixed_request())
+        for source, target in ((POINTS[0], POINTS[-1]), (POINTS[1], POINTS[7]), (POINTS[6], POINTS[8])):
+            best_path = graph.shortest_path(source, target)
+            on_chain = self.statistics(best_path, self.graph.chain)
+            by_section = self.statistics(best_path, None).statistic_data
+            for name in ('all_length', 'completed_length', 'remaining_length', 'length_percentage', 'all_elevation',
+                         'completed_elevation', 'completed_stamps', 'remaining_stamps', 'mozgalom_completed'):
+                self.assertEqual(getattr(on_chain.statistic_data, name), getattr(by_section, name), name)
+                self.assertEqual(type(getattr(on_chain.statistic_data, name)), type(getattr(by_section, name)), name)
+            # Summing once more only works off the chain when the fast path applies
+            self.assertIsNotNone(on_chain._sum_path_on_chain())
+
+
+class ParallelSectionChainTests(TrailChainFastPathTests):
+    '''The same checks on a trail with parallel DB sections between some of its points'''
+    def setUp(self):
+        super().setUp()
+        self.plain_chain = self.graph.chain
+        self.parallel = [
+            make_section(3, objectid=103, tav=Decimal("9.50")),
+            make_section(6, objectid=106),
+            make_section(6, objectid=116, szintemelkedes=40),
+        ]
+        self.graph = build_cache_graph([self.db_bhszd(section) for section in self.sections + self.parallel],
+                                       "OKT", self.bh_cache)
+
+    def test_parallel_sections_form_one_link(self):
+        chain = self.graph.chain
+        self.assertEqual([len(edges) for edges in chain.parallel_edges], [1, 1, 2, 1, 1, 3, 1, 1, 1, 0])
+        # The first of the equally cheap DB sections is the link, the others are not summed
+        self.assertIs(chain.links[2].bh_szakasz, self.sections[2])
+        self.assertIs(chain.links[5].bh_szakasz, self.sections[5])
+        for prefix in ('length', 'measured', 'climb'):
+            self.assertEqual(getattr(chain, prefix).tolist(), getattr(self.plain_chain, prefix).tolist())
+
+    def test_partially_masked_link(self):
+        graph = self.overlay([])
+        graph._masked.add(int(self.graph.chain.link_edges[2]))
+        graph._masked.add(int(self.graph.chain.link_edges[5]))
+        source, target = graph.node_id(POINTS[0]), graph.node_id(POINTS[-1])
+        fast = graph._path_along_chain(source, target)
+        self.assertEqual([id(bhszd) for bhszd in fast], [id(bhszd) for bhszd in self.full_search(graph, POINTS[0], POINTS[-1])])
+        self.assertIs(fast[2].bh_szakasz, self.parallel[0])
+        self.assertIs(fast[5].bh_szakasz, self.parallel[1])
+
+        graph._masked.update(self.graph.chain.parallel_edges[2])
+        self.assertIsNone(graph._path_along_chain(source, target))
+        self.assertIsNone(self.full_search(graph, POINTS[0], POINTS[-1]))
+
+
+class TieredCostModelTests(SimpleTestCase):
+    def setUp(self):
+        self.cost_model = TieredCostModel(NOW)
+        self.section = make_section(1)
+
+    def bhszd(self, stamp_type: StampType, stamped: datetime) -> BHSzD:
+        kezdopont = BHD(BHRecord(objectid=1, bh_id=POINTS[0]), stamped - timedelta(hours=1), stamp_type)
+        vegpont = BHD(BHRecord(objectid=2, bh_id=POINTS[1]), stamped, stamp_type)
+        return BHSzD(self.section, validation_time=stamped, stamp_type=stamp_type, mozgalom="OKT",
+                     kezdopont=kezdopont, vegpont=vegpont)
+
+    def test_tiers_and_age(self):
+        digital = self.cost_model.cost(self.bhszd(StampType.Digital, NOW - timedelta(days=30)))
+        register = self.cost_model.cost(self.bhszd(StampType.Kezi, NOW - timedelta(minutes=1)))
+        newer_digital = self.cost_model.cost(self.bhszd(StampType.Digital, NOW - timedelta(days=1)))
+        self.assertLess(digital, register)
+        self.assertLess(newer_digital, digital)
+        self.assertEqual(self.cost_model.cost(self.bhszd(StampType.Digital, NOW - timedelta(minutes=10))), 11)
+
+    def test_ties(self):
+        stamped = NOW - timedelta(days=3, seconds=20)
+        self.assertEqual(self.cost_model.cost(self.bhszd(StampType.Kezi, stamped)),
+                         self.cost_model.cost(self.bhszd(StampType.Kezi, stamped)))
+
+    def test_db_cost_dominates(self):
+        db = self.cost_model.cost(self.bhszd(StampType.DB, NOW))
+        self.assertEqual(db, DB_COST)
+        self.assertTrue(is_db_cost(db))
+        old_register = self.cost_model.cost(self.bhszd(StampType.Kezi, NOW - timedelta(days=365*30)))
+        self.assertFalse(is_db_cost(old_register))
+        self.assertLess(old_register*10000, db)
+
+
+class UnnotifiedTableRecheckTests(SimpleTestCase):
+    '''
+    The idle recheck of turamozgalom/nagyszakasz against the source_version entries, around change batches
+    of the other tables.
+    '''
+    def setUp(self):
+        self.fingerprints = {BH: 'bh-1', BHSzakasz: 'bhszakasz-1', Turamozgalom: 'turamozgalom-1', NagySzakasz: 'nagyszakasz-1'}
+        self.registry = SnapshotRegistry('graph_memory')
+        self.registry.publish(source_version=(task.SNAPSHOT_FORMAT_VERSION, *self.fingerprints.values()))
+        self.loaders = {model: mock.Mock() for model in task.TABLE_LOADERS}
+        for patcher in (
+            mock.patch.object(task, 'reference_snapshots', self.registry),
+            mock.patch.object(task, 'table_fingerprint', lambda model, edited_column: self.fingerprints[model]),
+            mock.patch.dict(task.TABLE_LOADERS, self.loaders),
+            mock.patch.object(task, 'apply_bhpont_changes', return_value={'OKT'}),
+            mock.patch.object(task, 'load_graph_cache'),
+            mock.patch.object(task, 'persist_reference_snapshot'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def bhpont_batch(self) -> ChangeBatch:
+        batch = ChangeBatch(0, 10)
+        batch.add('bhpont_changes', {'objectid': 1, 'operation': 'UPDATE'})
+        return batch
+
+    def test_batch_keeps_the_entries_of_patched_and_untouched_tables(self):
+        started = self.registry.current().source_version
+        self.fingerprints[BH] = 'bh-2'
+        task.apply_change_batch(self.bhpont_batch())
+        self.assertEqual(self.registry.current().generation, 2)
+        self.assertEqual(self.registry.current().source_version, started)
+
+    def test_unnotified_edit_before_a_batch_is_reloaded(self):
+        # nagyszakasz is edited without a trigger, then a bhpont batch publishes before the next recheck
+        self.fingerprints[NagySzakasz] = 'nagyszakasz-2'
+        self.fingerprints[BH] = 'bh-2'
+        task.apply_change_batch(self.bhpont_batch())
+        task.recheck_unnotified_tables()
+
+        self.loaders[NagySzakasz].assert_called_once()
+        self.loaders[Turamozgalom].assert_not_called()
+        self.loaders[BH].assert_not_called()
+        snapshot = self.registry.current()
+        self.assertEqual(snapshot.generation, 3)
+        self.assertEqual(snapshot.source_version[1:], ('bh-1', 'bhszakasz-1', 'turamozgalom-1', 'nagyszakasz-2'))
+
+        task.recheck_unnotified_tables()
+        self.assertEqual(self.registry.current().generation, 3)
+
+    def test_full_reload_records_the_table_fingerprint(self):
+        self.fingerprints[Turamozgalom] = 'turamozgalom-2'
+        batch = ChangeBatch(0, 10)
+        batch.add('turamozgalom_changes', None)
+        task.apply_change_batch(batch)
+        self.loaders[Turamozgalom].assert_called_once()
+        self.assertEqual(self.registry.current().source_version[3], 'turamozgalom-2')
+        task.recheck_unnotified_tables()
+        self.assertEqual(self.registry.current().generation, 2)
+
+    def test_resync_reloads_moved_tables_and_their_graphs(self):
+        self.assertIsNone(task.reload_changed_tables(task.TABLE_LOADERS))
+        task.load_graph_cache.assert_not_called()
+
+        self.fingerprints[BHSzakasz] = 'bhszakasz-2'
+        snapshot = task.reload_changed_tables(task.TABLE_LOADERS)
+        self.loaders[BHSzakasz].assert_called_once()
+        self.loaders[BH].assert_not_called()
+        task.load_graph_cache.assert_called_once()
+        self.assertEqual(snapshot.source_version[2], 'bhszakasz-2')
+
+
+class ChangeListenerReconnectTests(SimpleTestCase):
+    '''The change listener reconnects with backoff instead of dying with the builder lock held'''
+    class Stop(Exception):
+        pass
+
+    def setUp(self):
+        self.registry = SnapshotRegistry('graph_memory')
+        self.registry.publish(source_version=(task.SNAPSHOT_FORMAT_VERSION,))
+        self.sleep = mock.Mock(side_effect=[None, None, None, self.Stop])
+        for patcher in (
+            mock.patch.object(task, 'reference_snapshots', self.registry),
+            mock.patch.object(task.time, 'sleep', self.sleep),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_reconnects_with_backoff(self):
+        def resynced_then_lost():
+            self.assertEqual(self.registry.state, WarmupState.Stale)
+            self.registry.mark(WarmupState.Ready)
+            raise OSError('connection lost')
+
+        def refused():
+            raise OSError('refused')
+
+        connections = iter([refused, refused, resynced_then_lost, refused])
+        with mock.patch.object(task, '_listen_to_changes', side_effect=lambda: next(connections)()):
+            with self.assertRaises(self.Stop):
+                task.listen_to_changes()
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list],
+                         [task.WARMUP_RETRY_SECONDS, task.WARMUP_RETRY_SECONDS*2, task.WARMUP_RETRY_SECONDS,
+                          task.WARMUP_RETRY_SECONDS*2])
+        self.assertEqual(self.registry.state, WarmupState.Stale)
+
+
+class ColumnTableTests(SimpleTestCase):
+    def setUp(self):
+        self.points = [
+            make_point(1, "M1", datetime(2001, 1, 1), datetime(2005, 1, 1)),
+            make_point(2, "M1", datetime(2005, 1, 1)),
+            make_point(3, "M2", None, lat=None),
+            make_point(4, "M3", datetime(2010, 1, 1)),
+            make_point(5, "M4", datetime(2010, 1, 1)),
+        ]
+        self.table = make_table(BH, BHRecord, self.points)
+
+    def test_round_trip(self):
+        self.assertEqual([self.table.get(point.objectid) for point in self.points], self.points)
+        self.assertIs(self.table.get(1), self.table.record(self.table.position_of(1)))
+        self.assertIsNone(self.table.get(99))
+        self.assertEqual(len(self.table), 5)
+
+    def test_chunks(self):
+        offsets = []
+        chunked = make_table(BH, BHRecord, self.points, chunk_size=2,
+                             on_chunk=lambda chunk, offset: offsets.append((offset, len(chunk['objectid']))))
+        self.assertEqual(offsets, [(0, 2), (2, 2), (4, 1)])
+        for name, column in self.table.columns.items():
+            self.assertEqual(chunked.column(name).tolist(), column.tolist(), name)
+
+    def test_patched_keeps_the_original(self):
+        shared = self.table.get(1)
+        moved = make_point(2, "M9", datetime(2006, 1, 1))
+        added = make_point(6, "M6", datetime(2011, 1, 1))
+        patched = self.table.patched(removed=[2, 3], added=[moved, added])
+
+        self.assertEqual(patched.get(2), moved)
+        self.assertEqual(patched.get(6), added)
+        self.assertIsNone(patched.get(3))
+        self.assertEqual(patched.position_of(2), 5)
+        self.assertEqual(patched.live.tolist(), [True, False, False, True, True, True, True])
+        self.assertIs(patched.get(1), shared)
+        self.assertEqual(len(patched), 5)
+        # Readers of the original table are not disturbed
+        self.assertEqual(self.table.get(2), self.points[1])
+        self.assertEqual(self.table.get(3), self.points[2])
+        self.assertEqual(self.table.live.tolist(), [True]*5)
+        self.assertIsNone(self.table.get(6))
+
+    def test_compacted(self):
+        shared = self.table.get(4)
+        patched = self.table.patched(removed=[1, 2])
+        self.assertTrue(patched.needs_compaction())
+        self.assertFalse(self.table.patched(removed=[1]).needs_compaction())
+        compacted = patched.compacted()
+        self.assertEqual(compacted.live.tolist(), [True]*3)
+        self.assertEqual([compacted.position_of(objectid) for objectid in (3, 4, 5)], [0, 1, 2])
+        self.assertEqual([compacted.get(objectid) for objectid in (3, 4, 5)], self.points[2:])
+        self.assertIs(compacted.get(4), shared)
+        self.assertFalse(compacted.needs_compaction())
+
+
+class TemporalIndexTests(SimpleTestCase):
+    '''
+    The in-memory lookups follow the SQL they replace: start_date <= moment AND (end_date >= moment OR end_date
+    IS NULL), preferring the latest started version.
+    '''
+    def setUp(self):
+        self.points = [
+            make_point(1, "M1", datetime(2001, 1, 1), datetime(2005, 1, 1)),
+            make_point(2, "M1", datetime(2005, 1, 1)),
+            make_point(3, "M1", None),
+            make_point(4, "M2", datetime(2010, 1, 1)),
+        ]
+        self.table = make_table(BH, BHRecord, self.points)
+        self.index = BHPontIndex.from_table(self.table)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup("M1", datetime(2003, 1, 1)), self.points[0])
+        self.assertEqual(self.index.lookup("M1", datetime(2005, 1, 1)), self.points[1])
+        self.assertEqual(self.index.lookup("M1", datetime(2020, 1, 1)), self.points[1])
+        # A version without start_date is never valid
+        self.assertIsNone(self.index.lookup("M1", datetime(1990, 1, 1)))
+        self.assertIsNone(self.index.lookup("M2", datetime(2009, 1, 1)))
+        self.assertIsNone(self.index.lookup("M9", datetime(2020, 1, 1)))
+        self.assertEqual(self.index.records("M1"), [self.points[2], self.points[0], self.points[1]])
+        lookups = [("M1", datetime(2003, 1, 1)), ("M2", datetime(2011, 1, 1)), ("M1", datetime(2003, 1, 1))]
+        self.assertEqual(self.index.resolve_many(lookups), [self.points[0], self.points[3], self.points[0]])
+
+    def test_chunks_match_from_table(self):
+        index = BHPontIndex()
+        table = make_table(BH, BHRecord, self.points, chunk_size=3,
+                           on_chunk=lambda chunk, offset: index.add(chunk, range(offset, offset + len(chunk['objectid']))))
+        index.finish(table)
+        self.assertEqual(index._versions, self.index._versions)
+        self.assertEqual(index._starts, self.index._starts)
+
+    def test_patched_with_key_change(self):
+        moved = make_point(1, "M2", datetime(2012, 1, 1))
+        table = self.table.patched(removed=[1], added=[moved])
+        index = self.index.patched(table, removed=[self.table.position_of(1)], added=[table.position_of(1)])
+
+        self.assertIsNone(index.lookup("M1", datetime(2003, 1, 1)))
+        self.assertEqual(index.lookup("M2", datetime(2011, 1, 1)), self.points[3])
+        self.assertEqual(index.lookup("M2", datetime(2013, 1, 1)), moved)
+        self.assertEqual(index.versions("M1"), [2, 1])
+        # The original index still serves its readers
+        self.assertEqual(self.index.lookup("M1", datetime(2003, 1, 1)), self.points[0])
+        self.assertEqual(self.index.lookup("M2", datetime(2013, 1, 1)), self.points[3])
+
+        untouched = BHPontIndex.from_table(make_table(BH, BHRecord, self.points + [make_point(5, "M5", NOW)]))
+        patched = untouched.patched(untouched.table.patched(removed=[4]), removed=[3])
+        self.assertIs(patched.versions("M5"), untouched.versions("M5"))
+        self.assertEqual(patched.versions("M2"), [])
+        self.assertEqual(len(patched), 2)
+
+    def test_lookup_section_in_both_directions(self):
+        forward = make_section(1, start_date=datetime(2001, 1, 1))
+        backward = make_section(1, objectid=2, start_date=datetime(2001, 1, 1),
+                                kezdopont_bh_id=POINTS[1], vegpont_bh_id=POINTS[0])
+        old = make_section(2, objectid=3, start_date=datetime(2001, 1, 1), end_date=datetime(2004, 1, 1))
+        index = BHSzakaszIndex.from_table(make_table(BHSzakasz, BHSzakaszRecord, [forward, backward, old]))
+        self.assertEqual(index.lookup_section(POINTS[0], POINTS[1], "OKT", NOW), forward)
+        self.assertEqual(index.lookup_section(POINTS[1], POINTS[0], "OKT", NOW), backward)
+        self.assertEqual(index.lookup_section(POINTS[2], POINTS[1], "OKT", datetime(2003, 1, 1)), old)
+        self.assertIsNone(index.lookup_section(POINTS[1], POINTS[2], "OKT", NOW))
+        self.assertIsNone(index.lookup_section(POINTS[0], POINTS[1], "AK", NOW))
+
+    def test_nagyszakasz_covering(self):
+        def version(objectid, start_date, end_date):
+            return NagySzakaszRecord(objectid=objectid, nagyszakasz_id="OKT_1", start_date=start_date, end_date=end_date)
+        versions = [
+            version(1, datetime(2001, 1, 1), None),
+            version(2, datetime(2002, 1, 1), datetime(2030, 1, 1)),
+            version(3, datetime(2003, 1, 1), datetime(2020, 1, 1)),
+            version(4, None, datetime(2019, 1, 1)),
+        ]
+        index = NagySzakaszIndex.from_table(make_table(NagySzakasz, NagySzakaszRecord, versions))
+        # The earliest ending version covering the interval wins, an open ended one comes last
+        self.assertEqual(index.covering("OKT_1", datetime(2004, 1, 1), datetime(2010, 1, 1)), versions[2])
+        self.assertEqual(index.covering("OKT_1", datetime(2004, 1, 1), datetime(2025, 1, 1)), versions[1])
+        self.assertEqual(index.covering("OKT_1", datetime(2001, 6, 1), datetime(2040, 1, 1)), versions[0])
+        self.assertIsNone(index.covering("OKT_1", datetime(2000, 1, 1), datetime(2010, 1, 1)))
+        self.assertIsNone(index.covering("OKT_2", datetime(2004, 1, 1), datetime(2010, 1, 1)))
+
+
+class TableChangeTests(SimpleTestCase):
+    '''Delta updates of the snapshot tables from change notifications, the changed rows re-read in one query'''
+    def setUp(self):
+        self.points = [
+            make_point(1, "M1", datetime(2001, 1, 1), bh_id="OKTPH_1"),
+            make_point(2, "M2", datetime(2001, 1, 1), bh_id="AKPH_2"),
+            make_point(3, "M3", datetime(2001, 1, 1), bh_id="DDKPH_3"),
+            make_point(4, "M4", datetime(2001, 1, 1), bh_id="OKTPH_4"),
+            make_point(5, "M5", datetime(2001, 1, 1), bh_id="OKTPH_5"),
+        ]
+        table = make_table(BH, BHRecord, self.points)
+        self.draft = {'bhpont': table, 'bhpont_index': BHPontIndex.from_table(table)}
+
+    def database(self, model, rows):
+        '''Serve model.objects.filter(objectid__in=...).values(...) from the given records'''
+        def values(objectids):
+            return mock.Mock(values=lambda *columns: [
+                {column: getattr(row, column) for column in columns} for row in rows if row.objectid in objectids
+            ])
+        return mock.patch.object(model.objects, 'filter', side_effect=lambda objectid__in: values(objectid__in))
+
+    def test_apply_table_changes(self):
+        updated = make_point(1, "M9", datetime(2002, 1, 1), bh_id="OKTPH_1")
+        inserted = make_point(6, "M6", datetime(2002, 1, 1))
+        changes = [
+            {'objectid': 1, 'operation': 'UPDATE'},
+            {'objectid': 2, 'operation': 'DELETE'},
+            {'objectid': 6, 'operation': 'INSERT'},
+            {'objectid': 7, 'operation': 'DELETE'},
+        ]
+        table, index = self.draft['bhpont'], self.draft['bhpont_index']
+        with self.database(BH, [updated, inserted]):
+            patches = task._apply_table_changes(self.draft, 'bhpont', BH, changes)
+
+        self.assertEqual([(old, new) for _, old, new in patches],
+                         [(self.points[0], updated), (self.points[1], None), (None, inserted), (None, None)])
+        self.assertEqual(self.draft['bhpont'].get(1), updated)
+        self.assertIsNone(self.draft['bhpont'].get(2))
+        self.assertEqual(self.draft['bhpont_index'].lookup("M9", NOW), updated)
+        self.assertEqual(self.draft['bhpont_index'].lookup("M6", NOW), inserted)
+        self.assertIsNone(self.draft['bhpont_index'].lookup("M1", NOW))
+        self.assertIsNone(self.draft['bhpont_index'].lookup("M2", NOW))
+        # The snapshot being served keeps its table and index
+        self.assertEqual(table.get(1), self.points[0])
+        self.assertEqual(index.lookup("M2", NOW), self.points[1])
+
+    def test_apply_table_changes_compacts(self):
+        with self.database(BH, []):
+            task._apply_table_changes(self.draft, 'bhpont', BH, [
+                {'objectid': objectid, 'operation': 'DELETE'} for objectid in (1, 2)
+            ])
+        table = self.draft['bhpont']
+        self.assertEqual(len(table.live), 3)
+        self.assertEqual(self.draft['bhpont_index'].table, table)
+        self.assertEqual(self.draft['bhpont_index'].lookup("M4", NOW), self.points[3])
+
+    def test_bhpont_trails(self):
+        moved = make_point(2, "M2", datetime(2001, 1, 1), bh_id="DDKPH_2")
+        with self.database(BH, [moved]):
+            trails = task.apply_bhpont_changes(self.draft, [{'objectid': 2, 'operation': 'UPDATE'}])
+        self.assertEqual(trails, {'AK', 'RPDDK'})
+        with self.database(BH, []):
+            trails = task.apply_bhpont_changes(self.draft, [{'objectid': 99, 'operation': 'DELETE'}])
+        self.assertEqual(trails, set())
+
+    def test_bhszakasz_trails(self):
+        sections = [make_section(1), make_section(2, okk_mozgalom="AK"), make_section(3, end_date=datetime(2020, 1, 1))]
+        table = make_table(BHSzakasz, BHSzakaszRecord, sections)
+        draft = {'bhszakasz': table, 'bhszakasz_index': BHSzakaszIndex.from_table(table)}
+        changes = [
+            {'objectid': 2, 'operation': 'UPDATE'},
+            # Closed versions are in no current graph
+            {'objectid': 3, 'operation': 'UPDATE'},
+            # A row unknown before and after its change falls back to the trail of the payload
+            {'objectid': 50, 'operation': 'DELETE', 'okk_mozgalom': 'RPDDK'},
+            {'objectid': 51, 'operation': 'DELETE', 'okk_mozgalom': 'XX'},
+        ]
+        closed = make_section(2, okk_mozgalom="AK", end_date=datetime(2024, 1, 1))
+        with self.database(BHSzakasz, [closed, make_section(3, end_date=datetime(2021, 1, 1))]):
+            trails = task.apply_bhszakasz_changes(draft, changes)
+        self.assertEqual(trails, {'AK', 'RPDDK'})
+        self.assertEqual(draft['bhszakasz'].get(2), closed)
+
+
+class ChangeBatchTests(SimpleTestCase):
+    def test_merges_per_objectid(self):
+        batch = ChangeBatch(60, 10)
+        self.assertTrue(batch.empty)
+        self.assertIsNone(batch.remaining())
+        batch.add('bhpont_changes', {'objectid': 1, 'operation': 'INSERT'})
+        batch.add('bhpont_changes', {'objectid': 1, 'operation': 'UPDATE'})
+        batch.add('bhszakasz_changes', {'objectid': 1, 'operation': 'DELETE'})
+        self.assertEqual(batch.received, 3)
+        self.assertEqual(batch.merged, 2)
+        self.assertEqual(batch.changes['bhpont_changes'][1]['operation'], 'UPDATE')
+        self.assertFalse(batch.is_due())
+
+    def test_full_reload_drops_row_changes(self):
+        batch = ChangeBatch(60, 10)
+        batch.add('bhpont_changes', {'objectid': 1, 'operation': 'UPDATE'})
+        batch.add('bhpont_changes', None)
+        batch.add('bhpont_changes', {'objectid': 2, 'operation': 'UPDATE'})
+        self.assertEqual(batch.full_reload, {'bhpont_changes'})
+        self.assertNotIn('bhpont_changes', batch.changes)
+        self.assertEqual(batch.merged, 1)
+
+    def test_due(self):
+        batch = ChangeBatch(60, 2)
+        batch.add('bhpont_changes', {'objectid': 1, 'operation': 'UPDATE'})
+        self.assertFalse(batch.is_due())
+        batch.add('bhpont_changes', {'objectid': 2, 'operation': 'UPDATE'})
+        self.assertTrue(batch.is_due())
+        closed = ChangeBatch(0, 100)
+        closed.add('bhpont_changes', None)
+        self.assertTrue(closed.is_due())
+
+    def test_parse_change_payload(self):
+        self.assertEqual(task.parse_change_payload('{"objectid": 3, "operation": "DELETE"}'),
+                         {'objectid': 3, 'operation': 'DELETE'})
+        for payload in ('', 'not json', '[1]', '{"operation": "DELETE"}', None):
+            self.assertIsNone(task.parse_change_payload(payload))
+
+
+class SnapshotFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'reference.snapshot')
+        self.points = [make_point(1, "M1", datetime(2001, 1, 1)), make_point(2, "M2", None, lat=None)]
+        table = make_table(BH, BHRecord, self.points)
+        self.snapshot = ReferenceSnapshot(generation=3, source_version=(task.SNAPSHOT_FORMAT_VERSION, 'bh'),
+                                          bhpont=table, bhpont_index=BHPontIndex.from_table(table))
+
+    def test_round_trip(self):
+        file = SnapshotFile(self.path)
+        self.assertIsNone(file.stamp())
+        self.assertIsNone(file.attach())
+        file.write(self.snapshot, self.snapshot.generation)
+        attached = file.attach()
+
+        self.assertEqual(attached.generation, 3)
+        self.assertEqual(attached.source_version, self.snapshot.source_version)
+        self.assertEqual([attached.bhpont.get(point.objectid) for point in self.points], self.points)
+        self.assertEqual(attached.bhpont_index.lookup("M1", NOW), self.points[0])
+        self.assertIs(attached.bhpont_index.table, attached.bhpont)
+        # The numeric columns are views of the mapped file
+        self.assertFalse(attached.bhpont.column('start_date').flags.writeable)
+        self.assertIsNotNone(file.stamp())
+
+    def test_rewrite_changes_the_stamp(self):
+        file = SnapshotFile(self.path)
+        file.write(self.snapshot, 3)
+        stamp = file.stamp()
+        file.write(self.snapshot, 4)
+        self.assertNotEqual(file.stamp(), stamp)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'not a snapshot file' * 4)
+        self.assertIsNone(SnapshotFile(self.path).attach())
+
+
+class DatabaseFallbackTests(SimpleTestCase):
+    '''The batched DB fallback of the index misses, one query per table matched in memory'''
+    def test_get_many_from_db(self):
+        versions = [
+            BH(objectid=1, mtsz_id="M1", start_date=datetime(2001, 1, 1), end_date=datetime(2005, 1, 1)),
+            BH(objectid=2, mtsz_id="M1", start_date=datetime(2005, 1, 2)),
+            BH(objectid=3, mtsz_id="M2", start_date=None),
+        ]
+        lookups = [("M1", datetime(2003, 1, 1)), ("M1", datetime(2010, 1, 1)), ("M2", NOW), ("M3", NOW),
+                   ("M1", datetime(2003, 1, 1))]
+        with mock.patch.object(BH.objects, 'filter', return_value=versions) as query:
+            resolved = BH.get_many_from_DB(lookups)
+        query.assert_called_once_with(mtsz_id__in={"M1", "M2", "M3"})
+        self.assertEqual({lookup: bh and bh.objectid for lookup, bh in resolved.items()}, {
+            ("M1", datetime(2003, 1, 1)): 1, ("M1", datetime(2010, 1, 1)): 2, ("M2", NOW): None, ("M3", NOW): None,
+        })
+
+    def test_sections_in_both_directions(self):
+        sections = [
+            BHSzakasz(objectid=1, kezdopont_bh_id=POINTS[0], vegpont_bh_id=POINTS[1], okk_mozgalom="OKT",
+                      start_date=datetime(2001, 1, 1)),
+            BHSzakasz(objectid=2, kezdopont_bh_id=POINTS[2], vegpont_bh_id=POINTS[1], okk_mozgalom="OKT",
+                      start_date=datetime(2001, 1, 1), end_date=datetime(2002, 1, 1)),
+        ]
+        pairs = [(POINTS[0], POINTS[1], NOW), (POINTS[1], POINTS[2], datetime(2001, 6, 1)), (POINTS[1], POINTS[2], NOW)]
+        with mock.patch.object(BHSzakasz.objects, 'filter', return_value=sections) as query:
+            found = BHSzakasz.get_many_from_DB(pairs, "OKT")
+        query.assert_called_once()
+        self.assertEqual([section and section.objectid for section in found], [1, 2, None])
@@ -0,0 +1,112 @@
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+from challenges.compiled_graph import CompiledTrailGraph
+
+
+class TrailChain:
+    '''
+    Prefix sums along a trail graph whose DB sections form simple chains, no point branching or joining.
+    Parallel sections between the same two points count as one link, the cheapest one (first on ties, like
+    cheapest_parallel_edges).
+    The points are numbered chain after chain so every section joins position k to k+1, and the prefix arrays
+    hold, for each position, the totals of the sections before it: the length (tav scaled to its decimal places),
+    the number of sections with a known length and the climb. DB sections are always walked in their own
+    direction, so only their szintemelkedes is summed.
+    A stretch of the trail between two positions is then summed with two lookups.
+    On a chain the DB distance labels of the points are their positions, so `links`, the DB section leaving each
+    position (None at the end of a chain), is also the baseline DB-only path between any two of them, and
+    `link_edges` holds the CSR positions of those sections (-1 at the end of a chain) and `parallel_edges` the
+    CSR positions of every section the link stands for, so a link is only gone once all of them are masked.
+    '''
+    def __init__(self, positions: Dict[str, int], node_positions: np.ndarray, links: List[Optional[Any]],
+                 link_edges: np.ndarray, parallel_edges: List[Tuple[int, ...]], length: np.ndarray,
+                 measured: np.ndarray, climb: np.ndarray, places: int) -> None:
+        self.positions = positions
+        self.node_positions = node_positions
+        self.links = links
+        self.link_edges = link_edges
+        self.parallel_edges = parallel_edges
+        self.length = length
+        self.measured = measured
+        self.climb = climb
+        self.places = places
+
+    @classmethod
+    def from_graph(cls, graph: CompiledTrailGraph, places: int) -> Optional["TrailChain"]:
+        '''
+        The chains of a compiled trail graph, None when a point has sections to or from several points
+        or there is a cycle
+        '''
+        sources = np.repeat(np.arange(graph.num_nodes, dtype=np.int32), np.diff(graph.indptr))
+        joined = np.unique(np.stack([sources, graph.indices]), axis=1)
+        out_degree = np.bincount(joined[0], minlength=graph.num_nodes)
+        in_degree = np.bincount(joined[1], minlength=graph.num_nodes)
+        if out_degree.max(initial=0) > 1 or in_degree.max(initial=0) > 1:
+            return None
+
+        order: List[int] = []
+        links: List[Optional[Any]] = []
+        link_edges: List[int] = []
+        parallel_edges: List[Tuple[int, ...]] = []
+        for head in np.flatnonzero(in_degree == 0).tolist():
+            node = head
+            while True:
+                order.append(node)
+                if not out_degree[node]:
+                    links.append(None)
+                    link_edges.append(-1)
+                    parallel_edges.append(())
+                    break
+                edges = tuple(range(int(graph.indptr[node]), int(graph.indptr[node + 1])))
+                edge = min(edges, key=graph.weights.__getitem__)
+                links.append(graph.bhszds[int(graph.sections[edge])])
+                link_edges.append(edge)
+                parallel_edges.append(edges)
+                node = int(graph.indices[edge])
+        if len(order) != graph.num_nodes:
+            return None
+
+        # The link of the last position leads nowhere, prefix[k] sums the links before position k
+        link_values = [
+            (int(section.tav.scaleb(places)) if section.tav is not None else 0, section.tav is not None,
+             section.szintemelkedes or 0)
+            if section is not None else (0, False, 0)
+            for section in (link.bh_szakasz if link is not None else None for link in links[:-1])
+        ]
+        columns = np.asarray(link_values, dtype=np.int64).reshape(-1, 3)
+        prefix = np.zeros((len(order), 3), dtype=np.int64)
+        np.cumsum(columns, axis=0, out=prefix[1:])
+        node_positions = np.empty(graph.num_nodes, dtype=np.int32)
+        node_positions[order] = np.arange(graph.num_nodes, dtype=np.int32)
+        return cls(
+            positions={graph.node_ids[node]: position for position, node in enumerate(order)},
+            node_positions=node_positions,
+            links=links,
+            link_edges=np.asarray(link_edges, dtype=np.int64),
+            parallel_edges=parallel_edges,
+            length=prefix[:, 0].copy(),
+            measured=prefix[:, 1].copy(),
+            climb=prefix[:, 2].copy(),
+            places=places,
+        )
+
+    def position(self, bh_id: str) -> Optional[int]:
+        return self.positions.get(bh_id)
+
+    @staticmethod
+    def _span(prefix: np.ndarray, start: int, end: int) -> int:
+        return int(prefix[end] - prefix[start])
+
+    def length_between(self, start: int, end: int) -> int:
+        '''Scaled length of the sections from position `start` to `end`'''
+        return self._span(self.length, start, end)
+
+    def measured_between(self, start: int, end: int) -> int:
+        return self._span(self.measured, start, end)
+
+    def climb_between(self, start: int, end: int) -> int:
+        return self._span(self.climb, start, end)
+
+    def __len__(self) -> int:
+        return len(self.positions)
@@ -1,8 +1,9 @@
 from django.urls import path
-from .views import Challenges, Testing
+from .views import Challenges, Readiness, Testing
 
 
 urlpatterns = [
     path('challenges/', Challenges.as_view(), name='challenges'),
     path('testing/', Testing.as_view(), name='testing'),
+    path('challenges/ready/', Readiness.as_view(), name='readiness'),
 ]
\ No newline at end of file
@@ -6,9 +6,11 @@ from requests import Response
 from rest_framework.views import APIView
 from challenges.challenge_validation import ChallengeValidation
 from challenges.models import BH
+from challenges.snapshot import ReferenceDataNotReady
 from challenges.serializer import BH_Dev_Serializer, BHDSerializer, BHSzDSerializer, BHSzakasz_Dev_Serializer,  StatisticSerializer
 from router.exceptions import UnauthorizedException
 from router.views import verify_api_key
+from challenges.task import reference_snapshots
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework import status
@@ -22,6 +24,9 @@ class Challenges(APIView):
         language = self.request.data.get("language", "hu")
         if isinstance(exc, UnauthorizedException):
             return Response({'status': 'service_error', 'message': exc.message}, status=401)
+        if isinstance(exc, ReferenceDataNotReady):
+            return Response({'status': 'service_unavailable', 'message': str(exc)},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': str(exc.retry_after)})
         return super().handle_exception(exc)
     
 
@@ -52,6 +57,9 @@ class Testing(APIView):
         language = self.request.data.get("language", "hu")
         if isinstance(exc, UnauthorizedException):
             return Response({'status': 'service_error', 'message': exc.message}, status=401)
+        if isinstance(exc, ReferenceDataNotReady):
+            return Response({'status': 'service_unavailable', 'message': str(exc)},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': str(exc.retry_after)})
         return super().handle_exception(exc)
     
 
@@ -80,4 +88,14 @@ class Testing(APIView):
         }, status=status.HTTP_200_OK)
     
 
-    
\ No newline at end of file
+    
+
+
+class Readiness(APIView):
+    renderer_classes = [JSONRenderer]
+
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'state': reference_snapshots.state.value,
+            'generation': reference_snapshots.current().generation,
+        }, status=status.HTTP_200_OK if reference_snapshots.serving else status.HTTP_503_SERVICE_UNAVAILABLE)